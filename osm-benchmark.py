@@ -0,0 +1,402 @@
+"""
+Benchmark of the importers on a synthetic OSM historical file.
+
+A history file is generated with the given number of nodes, ways and
+relations, then each importer is run on it in its own process, writing
+to a database or to a null sink (rows are encoded but not sent). Entities
+per second, peak memory and the time of each phase are reported.
+
+Run using:
+    python osm-benchmark.py [--nodes=<n>] [--ways=<n>] [--relations=<n>]
+        [--versions=<n>] [--inside=<fraction>] [--file=<osmfile>]
+        [--importers=importer,smart,smart-v2,smart-v2-parallel]
+        [--db=<dbname>] [--copy[=binary]] [--workers=<n>] [--output=<file>]
+
+"""
+import osmium as o
+from osmium.osm.mutable import Node, Way, Relation
+import sys
+import os
+import json
+import time
+import random
+import subprocess
+import tempfile
+import shutil
+import atexit
+import importlib.util
+from datetime import datetime, timedelta, timezone
+
+DB_USER='Julien'
+DB_PWD=''
+DB_HOST='localhost'
+DB_PORT='5433'
+
+# Zone of the import, given as the importers take it: bottom left
+# latitude and longitude, then top right latitude and longitude
+ZONE=[437200000, 74000000, 437500000, 74250000]
+
+IMPORTERS = {
+    'importer': 'osm-importer.py',
+    'smart': 'osm-smart-importer.py',
+    'smart-v2': 'osm-smart-importer-v2.py',
+    'smart-v2-parallel': 'osm-smart-importer-v2.py',
+}
+
+TABLES=['nodes','ways','ways_nodes','relations','relations_members']
+
+# ============= Synthetic history file ==============
+
+class HistoryGenerator(object):
+    """write a sorted history file of random entities.
+
+    Each entity has between 1 and twice the average number of versions. Nodes
+    are inside the zone with the given probability, ways reference nearby
+    nodes and relations reference nodes, ways and earlier relations."""
+
+    def __init__(self, nodes, ways, relations, versions, inside, seed=1):
+        self.nodes = nodes
+        self.ways = ways
+        self.relations = relations
+        self.versions = versions
+        self.inside = inside
+        self.random = random.Random(seed)
+        self.start = datetime(2010, 1, 1, tzinfo=timezone.utc)
+        self.changeset = 0
+
+    def versionCount(self):
+        return self.random.randint(1, max(1, 2*self.versions-1))
+
+    # Timestamps of the versions of an entity, spread over ten years
+    def timestamps(self, count):
+        return sorted(self.start + timedelta(seconds=self.random.randint(0, 10*365*86400)) for i in range(count))
+
+    def user(self):
+        uid = self.random.randint(1, 500)
+        self.changeset += 1
+        return dict(uid=uid, user="user "+str(uid), changeset=self.changeset)
+
+    # Location in degrees, inside or outside the zone
+    def location(self):
+        lat = self.random.uniform(ZONE[0], ZONE[2]) / 10000000
+        lon = self.random.uniform(ZONE[1], ZONE[3]) / 10000000
+        if self.random.random() >= self.inside:
+            lon += 1
+        return (lon, lat)
+
+    def write(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        header = o.io.Header()
+        header.has_multiple_object_versions = True
+        writer = o.SimpleWriter(path, header=header)
+
+        for id in range(1, self.nodes+1):
+            location = self.location()
+            count = self.versionCount()
+            for version, timestamp in enumerate(self.timestamps(count), 1):
+                tags = {'name': 'node '+str(id)} if self.random.random() < 0.1 else {}
+                writer.add_node(Node(id=id, version=version, visible=version < count or self.random.random() > 0.1,
+                    timestamp=timestamp, tags=tags, location=location, **self.user()))
+
+        for id in range(1, self.ways+1):
+            first = self.random.randint(1, self.nodes)
+            refs = [min(self.nodes, first+i) for i in range(self.random.randint(2, 10))]
+            for version, timestamp in enumerate(self.timestamps(self.versionCount()), 1):
+                writer.add_way(Way(id=id, version=version, timestamp=timestamp,
+                    tags={'highway': 'residential'}, nodes=refs, **self.user()))
+
+        for id in range(1, self.relations+1):
+            members = [('n', self.random.randint(1, self.nodes), 'stop'), ('w', self.random.randint(1, max(1, self.ways)), 'outer')]
+            if id > 1:
+                members.append(('r', self.random.randint(1, id-1), ''))
+            for version, timestamp in enumerate(self.timestamps(self.versionCount()), 1):
+                writer.add_relation(Relation(id=id, version=version, timestamp=timestamp,
+                    tags={'type': 'route'}, members=members, **self.user()))
+
+        writer.close()
+
+class CountHandler(o.SimpleHandler):
+    """count the entities of a file."""
+
+    def __init__(self):
+        super(CountHandler, self).__init__()
+        self.count = 0
+
+    def node(self, n):
+        self.count += 1
+
+    def way(self, w):
+        self.count += 1
+
+    def relation(self, r):
+        self.count += 1
+
+# ============= Null sink ==============
+
+class NullCursor(object):
+    """cursor discarding everything, rows sent with COPY are read anyway."""
+
+    def execute(self, command, params=None):
+        pass
+
+    def copy_expert(self, command, data, size=8192):
+        data.read()
+
+    def fetchone(self):
+        return None
+
+    def close(self):
+        pass
+
+class NullConnection(object):
+
+    def cursor(self, name=None):
+        return NullCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class NullDB(object):
+    """stand-in for the DB class of the importers."""
+
+    def __init__(self):
+        self.connection = NullConnection()
+        self.tables = dict((table, table) for table in TABLES)
+
+    def execute(self, commands=[], tables=None):
+        return 0
+
+    def executeAndReturn(self, command):
+        return None
+
+# ============= Import runs ==============
+
+def loadImporter(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), IMPORTERS[name])
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    # Functions sent to worker processes are found by their module name
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# Drop the tables of a previous run
+def dropTables(module):
+    db = module.DB()
+    db.execute(["DROP TABLE IF EXISTS "+", ".join(reversed(TABLES))+", "+", ".join(table+"_staging" for table in TABLES)+", import_checkpoint CASCADE"])
+    db.connection.close()
+
+def openWriter(module, db, copy_mode):
+    if copy_mode:
+        return module.CopyWriter(db, binary=(copy_mode == 'binary'))
+    return module.InsertWriter(db)
+
+def timed(phases, name, function, *args):
+    start = time.time()
+    function(*args)
+    phases.append((name, time.time()-start))
+
+def runImporter(module, path, db, copy_mode, options):
+    phases = []
+    h = module.FileStatsHandler(openWriter(module, db, copy_mode))
+    timed(phases, "Parsing", h.apply_file, path)
+    timed(phases, "Nodes", h.nodes.executeImport)
+    timed(phases, "Ways", h.ways.executeImport)
+    timed(phases, "Relations", h.rels.executeImport)
+    return phases
+
+def runSmart(module, path, db, copy_mode, options):
+    phases = []
+    n = module.FileHandler(db, openWriter(module, db, copy_mode))
+    timed(phases, "Nodes", n.apply_file, path)
+    n.end_nodes()
+    timed(phases, "Ways and relations", n.apply_file, path)
+    timed(phases, "Writing", n.finish_remaining_commands)
+    return phases
+
+def runSmartV2(module, path, db, copy_mode, options):
+    module.BOTTOM_LEFT_BOUNDARY[0], module.BOTTOM_LEFT_BOUNDARY[1] = ZONE[0], ZONE[1]
+    module.TOP_RIGHT_BOUNDARY[0], module.TOP_RIGHT_BOUNDARY[1] = ZONE[2], ZONE[3]
+    # Used by the log of phases
+    module.starting_time = time.time()
+
+    writer = openWriter(module, db, copy_mode)
+    writer.checkpoint = module.Checkpoint(path)
+    n = module.FileHandler(db, writer, options['workers'], parallel=options['parallel'])
+    phases = []
+    for phase in [module.NODE_TYPE, module.WAY_TYPE, module.RELATION_TYPE]:
+        # Starting a phase writes what is left of the previous one
+        start = time.time()
+        n.startPhase(phase)
+        n.read(path)
+        phases.append((phase, time.time()-start))
+    timed(phases, "Writing", finishSmartV2, n, writer)
+    return phases
+
+def finishSmartV2(n, writer):
+    n.finish_remaining_commands()
+    n.closePool()
+    writer.close()
+
+RUNS = {
+    'importer': runImporter,
+    'smart': runSmart,
+    'smart-v2': runSmartV2,
+    'smart-v2-parallel': runSmartV2,
+}
+
+# Run one importer in this process and write its phases to result_path
+def runChild(name, path, dbname, copy_mode, workers, result_path):
+    module = loadImporter(name)
+    module.DB_NAME = dbname or 'benchmark'
+    module.DB_USER, module.DB_PWD, module.DB_HOST, module.DB_PORT = DB_USER, DB_PWD, DB_HOST, DB_PORT
+    if dbname:
+        dropTables(module)
+        db = module.DB()
+    else:
+        db = NullDB()
+
+    options = {'workers': workers, 'parallel': name == 'smart-v2-parallel'}
+    phases = RUNS[name](module, path, db, copy_mode, options)
+
+    file = open(result_path, "w")
+    file.write(json.dumps(phases))
+    file.close()
+
+# Tell if an importer reported SQL errors or discarded rows
+def failedRun(output):
+    return 'SQL ERROR' in output or ' discarded...' in output or ' saved in ' in output
+
+# Run one importer in a child process, return its phases and peak memory
+def runImport(name, path, dbname, copy_mode, workers, verbose):
+    # The importers write their logs in logs/ of the working directory,
+    # the phases are written there too. It is removed once read.
+    workdir = tempfile.mkdtemp()
+    try:
+        return runInDirectory(workdir, name, path, dbname, copy_mode, workers, verbose)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def runInDirectory(workdir, name, path, dbname, copy_mode, workers, verbose):
+    result_path = os.path.join(workdir, 'result.json')
+    command = [sys.executable, os.path.abspath(__file__), '--child='+name, '--workers='+str(workers), os.path.abspath(path), result_path]
+    if dbname:
+        command.append('--db='+dbname)
+    if copy_mode:
+        command.append('--copy' if copy_mode == True else '--copy='+copy_mode)
+
+    os.mkdir(os.path.join(workdir, 'logs'))
+    output_path = os.path.join(workdir, 'output.txt')
+    output = open(output_path, "w")
+    child = subprocess.Popen(command, cwd=workdir, stdout=output, stderr=subprocess.STDOUT)
+    pid, status, usage = os.wait4(child.pid, 0)
+    output.close()
+    file = open(output_path)
+    output = file.read()
+    file.close()
+    if verbose:
+        print(output)
+    # Importers ignoring SQL errors go on, but their timings are meaningless
+    if status != 0 or failedRun(output):
+        print('\033[91m'+"ERROR: "+name+" failed, run with --verbose to see its output."+'\033[0m')
+        return None
+
+    file = open(result_path)
+    phases = json.load(file)
+    file.close()
+    # ru_maxrss is in kilobytes on Linux
+    return {'importer': name, 'phases': phases, 'peak_memory_mb': round(usage.ru_maxrss/1024, 1)}
+
+# Extract "--name" or "--name=value" from the command line arguments
+def getOption(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg == '--'+name:
+            sys.argv.remove(arg)
+            return True
+        if arg.startswith('--'+name+'='):
+            sys.argv.remove(arg)
+            return arg.split('=',1)[1]
+    return default
+
+
+if __name__ == '__main__':
+    white = '\033[0m'
+    blue = '\033[94m'
+    green = '\033[92m'
+
+    child = getOption('child')
+    dbname = getOption('db')
+    copy_mode = getOption('copy')
+    workers = getOption('workers', True)
+
+    # One worker per CPU by default, as with a bare --workers
+    if workers == True:
+        workers = os.cpu_count()
+    elif not workers.isdigit() or int(workers) < 1:
+        print('\033[91m'+"--workers needs a number of workers, at least 1."+'\033[0m')
+        sys.exit(-1)
+    else:
+        workers = int(workers)
+
+    if child:
+        runChild(child, sys.argv[1], dbname, copy_mode, workers, sys.argv[2])
+        sys.exit(0)
+
+    nodes = int(getOption('nodes', 100000))
+    ways = int(getOption('ways', 15000))
+    relations = int(getOption('relations', 1000))
+    versions = int(getOption('versions', 2))
+    inside = float(getOption('inside', 0.5))
+    path = getOption('file')
+    importers = getOption('importers', ','.join(IMPORTERS)).split(',')
+    output = getOption('output')
+    verbose = getOption('verbose', False)
+
+    for name in importers:
+        if name not in IMPORTERS:
+            print('\033[91m'+"Unknown importer: "+name+", use one of "+", ".join(IMPORTERS)+"."+'\033[0m')
+            sys.exit(-1)
+
+    print("\n=================================")
+    print("======= "+blue+"OSM Importers Benchmark "+white+"=======")
+    print("=================================")
+
+    if path == None:
+        # A generated file is removed when the benchmark exits, not a given one
+        generated = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, generated, True)
+        path = os.path.join(generated, 'benchmark.osh.pbf')
+        print("Generating "+str(nodes)+" nodes, "+str(ways)+" ways and "+str(relations)+" relations... ",end='')
+        sys.stdout.flush()
+        HistoryGenerator(nodes, ways, relations, versions, inside).write(path)
+        print("OK")
+
+    counter = CountHandler()
+    counter.apply_file(path)
+    print("File: "+path+", "+str(counter.count)+" entity versions, "+str(os.path.getsize(path)//1024)+"KB")
+    print("Sink: "+("database "+dbname if dbname else "null")+"\n")
+
+    results = []
+    for name in importers:
+        print("Running "+name+"... ",end='')
+        sys.stdout.flush()
+        result = runImport(name, path, dbname, copy_mode, workers, verbose)
+        if result == None:
+            continue
+        total = sum(seconds for phase, seconds in result['phases'])
+        result['seconds'] = round(total, 3)
+        result['entities_per_sec'] = round(counter.count/total, 1)
+        results.append(result)
+        print(green+"OK"+white)
+        print("  %.2fs, %d entities/s, peak memory %.1fMB" % (total, result['entities_per_sec'], result['peak_memory_mb']))
+        for phase, seconds in result['phases']:
+            print("  %-20s %.2fs" % (phase, seconds))
+
+    if output:
+        file = open(output, "w")
+        file.write(json.dumps({'file': path, 'entities': counter.count, 'sink': dbname or 'null', 'results': results}, indent=2))
+        file.close()
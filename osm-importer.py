@@ -8,11 +8,21 @@ Simply modify the DB variables, and run using:
 """
 import osmium as o
 import sys
-from datetime import date
+import io
+import struct
+from datetime import date, datetime, timezone
+from collections import deque
+from threading import Thread, Condition
 from progress.bar import Bar
 import psycopg2
 import pprint
 import json
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    # Only needed by --stats
+    np = None
 
 DB_NAME='osmukraine'
 DB_USER='Julien'
@@ -24,6 +34,32 @@ NODE_TYPE="Nodes"
 WAY_TYPE="Ways"
 RELATION_TYPE="Relations"
 
+# In streaming mode, rows are handed to the writer thread by batches
+STREAM_BATCH_SIZE = 10000
+# Rough size in memory of a row tuple, without its strings
+ROW_OVERHEAD = 300
+
+# Versions aggregated at once by --stats
+STATS_BATCH_SIZE = 1000000
+# Days, users, changesets and version counts listed by --stats
+STATS_TOP = 10
+# Coordinate of the locations of deleted nodes
+UNDEFINED_COORDINATE = 2147483647
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Tables in the order they have to be loaded (parents before children)
+TABLES=['nodes','ways','ways_nodes','relations','relations_members']
+
+# Column types used to encode rows for COPY ... (FORMAT binary):
+# q=bigint, i=int, b=boolean, t=timestamp, s=text/varchar/char, j=jsonb
+COPY_TYPES = {
+    'nodes': 'qbbqqqtsiij',
+    'ways': 'qbbqqqtsj',
+    'ways_nodes': 'qqqq',
+    'relations': 'qbbqqqtsj',
+    'relations_members': 'qqqssq',
+}
+
 class DB(object):
     """encaspulate a database connection."""
 
@@ -104,39 +140,224 @@ class DB(object):
 
         self.execute(commands)
 
-    def execute(self,commands=[],total=0):
-
-        if total != 0:
-            bar = Bar('Processing', max=total, suffix='%(percent)d%% - %(elapsed)ds')
-
+    def execute(self,commands=[]):
         try:
             cur = self.connection.cursor()
             # create table one by one
             for command in commands:
                 cur.execute(command)
-                if total != 0 and "relations_members" not in command and "ways_nodes" not in command:
-                    bar.next()
             # close communication with the PostgreSQL database server
             cur.close()
-            if total != 0:
-                bar.finish()
             # commit the changes
             self.connection.commit()
         except (Exception, psycopg2.DatabaseError) as error:
             print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
             sys.exit(-1)
 
+# ============= Row writers ==============
+
+class InsertWriter(object):
+    """write rows as one INSERT statement per row."""
+
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+        self.pending = 0
+
+    def add(self, table, row):
+        self.commands.append("INSERT INTO "+table+" VALUES ("+",".join(sqlValue(v) for v in row)+");")
+        self.pending += 1
+
+    def flush(self):
+        self.db.execute(self.commands)
+        self.commands = []
+        self.pending = 0
+
+class CopyWriter(object):
+    """buffer rows per table and stream them with COPY ... FROM STDIN."""
+
+    def __init__(self, db, binary=False):
+        self.db = db
+        self.binary = binary
+        self.pending = 0
+        self.buffers = {}
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if binary else io.StringIO()
+
+    def add(self, table, row):
+        if self.binary:
+            self.buffers[table].write(copyBinaryRow(COPY_TYPES[table], row))
+        else:
+            self.buffers[table].write('\t'.join(copyTextValue(v) for v in row)+'\n')
+        self.pending += 1
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        try:
+            cur = self.db.connection.cursor()
+            # Parents are loaded first so that foreign keys are satisfied
+            for table in TABLES:
+                data = self.buffers[table].getvalue()
+                if len(data) == 0:
+                    continue
+                if self.binary:
+                    data = COPY_BINARY_HEADER + data + COPY_BINARY_TRAILER
+                    cur.copy_expert("COPY "+table+" FROM STDIN WITH (FORMAT binary)", io.BytesIO(data))
+                else:
+                    cur.copy_expert("COPY "+table+" FROM STDIN", io.StringIO(data))
+            cur.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+            sys.exit(-1)
+        else:
+            self.db.connection.commit()
+
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if self.binary else io.StringIO()
+        self.pending = 0
+
+# Escape characters having a special meaning in COPY text format
+COPY_TEXT_ESCAPES = str.maketrans({'\\':'\\\\', '\t':'\\t', '\n':'\\n', '\r':'\\r'})
+
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+def sqlValue(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (bool, int)):
+        return str(value)
+    return "'"+str(value).replace("'","''")+"'"
+
+def copyTextValue(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+def copyBinaryRow(types, row):
+    data = [struct.pack('>h', len(row))]
+    for type, value in zip(types, row):
+        if value is None:
+            data.append(struct.pack('>i', -1))
+        elif type == 'q':
+            data.append(struct.pack('>iq', 8, value))
+        elif type == 'i':
+            data.append(struct.pack('>ii', 4, value))
+        elif type == 'b':
+            data.append(struct.pack('>i?', 1, value))
+        elif type == 't':
+            data.append(struct.pack('>iq', 8, timestampMicros(value)))
+        elif type == 'j':
+            # jsonb binary format is a version byte followed by the text
+            encoded = str(value).encode('utf-8')
+            data.append(struct.pack('>ib', len(encoded)+1, 1))
+            data.append(encoded)
+        else:
+            encoded = str(value).encode('utf-8')
+            data.append(struct.pack('>i', len(encoded)))
+            data.append(encoded)
+    return b''.join(data)
+
+# Microseconds since 2000-01-01, the PostgreSQL timestamp epoch
+def timestampMicros(ts):
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    delta = ts - PG_EPOCH
+    return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+
+
+# ============= Streaming ==============
+
+class RowQueue(object):
+    """bounded queue of row batches, limited by their estimated size in bytes."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.batches = deque()
+        self.closed = False
+        self.aborted = False
+        self.condition = Condition()
+
+    def put(self, batch, size):
+        with self.condition:
+            # Block the parser while the writer is behind (backpressure)
+            while self.size > 0 and self.size + size > self.max_size and not self.aborted:
+                self.condition.wait()
+            if self.aborted:
+                sys.exit(-1)
+            self.batches.append((batch, size))
+            self.size += size
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while len(self.batches) == 0 and not self.closed:
+                self.condition.wait()
+            if len(self.batches) == 0:
+                return None
+            batch, size = self.batches.popleft()
+            self.size -= size
+            self.condition.notify_all()
+            return batch
+
+    # No more batches will be added
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    # The writer stopped, wake up and stop the parser
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+class StreamWriter(Thread):
+    """drain a RowQueue into a writer while the file is being parsed."""
+
+    def __init__(self, queue, writer):
+        Thread.__init__(self)
+        self.queue = queue
+        self.writer = writer
+        self.written = 0
+        self.failed = False
+
+    def run(self):
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch == None:
+                    break
+                for table, row in batch:
+                    self.writer.add(table, row)
+                if self.writer.pending > 100000:
+                    self.writer.flush()
+                self.written += len(batch)
+            self.writer.flush()
+        except BaseException:
+            self.failed = True
+            self.queue.abort()
 
 class Importer(object):
 
-    def __init__(self,datatype, db):
+    def __init__(self,datatype, writer, queue=None):
         self.added = 0
         self.modified = 0
         self.deleted = 0
-        self.db = db
+        self.writer = writer
 
         self.datatype=datatype
-        self.insertion_commands=[]
+        self.insertion_rows=[]
+
+        # Streaming mode: rows are pushed to the queue instead of kept
+        self.queue = queue
+        self.batch_size = 0
 
     # Deal with one entity (node, way or relation)
     def add(self, o):
@@ -151,67 +372,83 @@ class Importer(object):
         o.jsontags = self.jsonifyTags(o.tags)
 
         if self.datatype==NODE_TYPE:
-            self.insertion_commands.append(self.insertNodeSQL(o))
+            rows = self.nodeRows(o)
         elif self.datatype==WAY_TYPE:
-            self.insertion_commands += self.insertWaySQL(o)
+            rows = self.wayRows(o)
         elif self.datatype==RELATION_TYPE:
-            self.insertion_commands += self.insertRelationSQL(o)
+            rows = self.relationRows(o)
         else:
             print('\033[91m'+"\nERROR: type"+str( self.datatype)+" not found, or not handled."+'\033[0m')
             sys.exit(-1)
 
+        self.insertion_rows += rows
+
+        if self.queue != None:
+            self.batch_size += ROW_OVERHEAD*len(rows) + len(o.jsontags) + len(o.user)
+            if len(self.insertion_rows) >= STREAM_BATCH_SIZE:
+                self.pushRows()
+
+    # Hand the current rows over to the writer thread
+    def pushRows(self):
+        if len(self.insertion_rows) == 0:
+            return
+        self.queue.put(self.insertion_rows, self.batch_size)
+        self.insertion_rows = []
+        self.batch_size = 0
+
     def jsonifyTags(self,tags):
 
         jsontags={}
         for tag in tags:
-            jsontags[tag.k.replace("'","")] = tag.v.replace("'","")
+            jsontags[tag.k] = tag.v
 
         return json.dumps(jsontags)
 
     def executeImport(self):
-        self.db.execute(self.insertion_commands,self.added+self.modified+self.deleted)
-
-    # Return a SQL command to insert a node
-    def insertNodeSQL(self,o):
+        bar = Bar('Processing', max=self.added+self.modified+self.deleted, suffix='%(percent)d%% - %(elapsed)ds')
+        for table, row in self.insertion_rows:
+            self.writer.add(table, row)
+            if table != "relations_members" and table != "ways_nodes":
+                bar.next()
+            if self.writer.pending > 100000:
+                self.writer.flush()
+        self.writer.flush()
+        bar.finish()
+
+    # Return the row to insert a node
+    def nodeRows(self,o):
         if self.datatype!=NODE_TYPE:
             return
 
-        query =  """INSERT INTO nodes VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}',
-        {8},{9},'{10}');"""
-
-        return query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""),o.location.x, o.location.y, o.jsontags)
+        return [('nodes', (o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user,o.location.x, o.location.y, o.jsontags))]
 
-    # Return am array of SQL commands to insert a way
-    def insertWaySQL(self,o):
+    # Return the rows to insert a way and its nodes
+    def wayRows(self,o):
         if self.datatype!=WAY_TYPE:
             return
-        query = """INSERT INTO ways VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}','{8}');"""
 
-        queries = [query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""), o.jsontags)]
+        rows = [('ways', (o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user, o.jsontags))]
 
-        node_way_query = """ INSERT INTO ways_nodes VALUES ({0}, {1}, {2}, {3}) """
         sequence_id=0
         for node in o.nodes:
-            queries.append( node_way_query.format(o.id,o.version,node.ref,sequence_id) )
+            rows.append( ('ways_nodes', (o.id,o.version,node.ref,sequence_id)) )
             sequence_id += 1
 
-        return queries
+        return rows
 
-    # Return am array of SQL commands to insert a relation
-    def insertRelationSQL(self,o):
+    # Return the rows to insert a relation and its members
+    def relationRows(self,o):
         if self.datatype!=RELATION_TYPE:
             return
-        query = """INSERT INTO relations VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}','{8}');"""
 
-        queries = [query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""), o.jsontags)]
+        rows = [('relations', (o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user, o.jsontags))]
 
-        node_way_query = """ INSERT INTO relations_members VALUES ({0}, {1}, {2}, '{3}', '{4}', {5}) """
         sequence_id=0
         for member in o.members:
-            queries.append( node_way_query.format(o.id,o.version,member.ref,member.type.replace("'",""),member.role.replace("'",""),sequence_id) )
+            rows.append( ('relations_members', (o.id,o.version,member.ref,member.type,member.role,sequence_id)) )
             sequence_id += 1
 
-        return queries
+        return rows
 
     # Print stats of inserted items
     def outstats(self):
@@ -220,21 +457,294 @@ class Importer(object):
         print("%s deleted: %d" % (self.datatype, self.deleted))
 
 class FileStatsHandler(o.SimpleHandler):
-    def __init__(self, db):
+    def __init__(self, writer, queue=None):
         super(FileStatsHandler, self).__init__()
-        self.nodes = Importer(NODE_TYPE,db)
-        self.ways = Importer(WAY_TYPE,db)
-        self.rels = Importer(RELATION_TYPE,db)
+        self.nodes = Importer(NODE_TYPE,writer,queue)
+        self.ways = Importer(WAY_TYPE,writer,queue)
+        self.rels = Importer(RELATION_TYPE,writer,queue)
 
     def node(self, n):
         self.nodes.add(n)
 
     def way(self, w):
-	    self.ways.add(w)
+        # Nodes are all parsed, don't keep them until the end of the file
+        if self.nodes.queue != None:
+            self.nodes.pushRows()
+        self.ways.add(w)
 
     def relation(self, r):
-	    self.rels.add(r)
+        if self.ways.queue != None:
+            self.ways.pushRows()
+        self.rels.add(r)
+
+    # Streaming mode: push the rows left once the file is parsed
+    def finish_stream(self):
+        self.nodes.pushRows()
+        self.ways.pushRows()
+        self.rels.pushRows()
+
+# ============= Statistics ==============
+
+class KeyCounter(object):
+    """count the versions of each user or changeset.
+
+    Keys of a batch are counted with np.unique, and the counts of the
+    batches are merged once they outgrow the merged counts."""
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def __len__(self):
+        self.merge()
+        return len(self.keys)
+
+    def add(self, keys):
+        keys, counts = np.unique(keys, return_counts=True)
+        self.pending.append((keys, counts))
+        self.pending_size += len(keys)
+        if self.pending_size > max(STATS_BATCH_SIZE, len(self.keys)):
+            self.merge()
+
+    def merge(self):
+        if len(self.pending) == 0:
+            return
+        keys = np.concatenate([self.keys] + [keys for keys, counts in self.pending])
+        counts = np.concatenate([self.counts] + [counts for keys, counts in self.pending])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.zeros(len(self.keys), dtype=np.int64)
+        np.add.at(self.counts, inverse, counts)
+        self.pending = []
+        self.pending_size = 0
+
+    # Most frequent keys, as (key, count) pairs
+    def top(self, n):
+        self.merge()
+        order = np.argsort(-self.counts, kind='stable')[:n]
+        return list(zip(self.keys[order].tolist(), self.counts[order].tolist()))
+
+# Add the counts of a batch to a growing array of counts
+def addCounts(total, counts):
+    if len(counts) > len(total):
+        counts[:len(total)] += total
+        return counts
+    total[:len(counts)] += counts
+    return total
+
+class FileStats(object):
+    """statistics of the versions of all types: edits per day, users,
+    changesets, and bounding box of the node locations."""
+
+    def __init__(self):
+        self.days = np.zeros(0, dtype=np.int64)
+        self.users = KeyCounter()
+        self.changesets = KeyCounter()
+        # Name of each user id, names are not part of the arrays
+        self.user_names = {}
+        self.bbox = None
+
+    def add(self, days, uids, changesets):
+        self.days = addCounts(self.days, np.bincount(days))
+        self.users.add(uids)
+        self.changesets.add(changesets)
+
+    # Extend the bounding box with the valid locations of a batch of nodes
+    def addLocations(self, x, y):
+        valid = x != UNDEFINED_COORDINATE
+        if not valid.any():
+            return
+        x = x[valid]
+        y = y[valid]
+        bbox = (int(x.min()), int(y.min()), int(x.max()), int(y.max()))
+        if self.bbox != None:
+            bbox = (min(bbox[0], self.bbox[0]), min(bbox[1], self.bbox[1]), max(bbox[2], self.bbox[2]), max(bbox[3], self.bbox[3]))
+        self.bbox = bbox
+
+    def outstats(self):
+        active = np.flatnonzero(self.days)
+        if len(active) > 0:
+            print("Edits from %s to %s, on %d days" % (dayName(active[0]), dayName(active[-1]), len(active)))
+            print("Busiest days:")
+            for day in np.argsort(-self.days, kind='stable')[:min(STATS_TOP, len(active))]:
+                print("  %s: %d" % (dayName(day), self.days[day]))
+        print("Users: %d" % len(self.users))
+        for uid, count in self.users.top(STATS_TOP):
+            print("  %s (%d): %d" % (self.user_names.get(uid, ''), uid, count))
+        print("Changesets: %d" % len(self.changesets))
+        for changeset, count in self.changesets.top(STATS_TOP):
+            print("  %d: %d" % (changeset, count))
+        if self.bbox != None:
+            print("Nodes bounding box: %d %d %d %d (%.7f %.7f %.7f %.7f)" % (self.bbox + tuple(v/10000000 for v in self.bbox)))
+
+    def json(self):
+        active = np.flatnonzero(self.days)
+        return {
+            'edits_per_day': {dayName(day): int(self.days[day]) for day in active},
+            'users': len(self.users),
+            'top_users': [{'uid': uid, 'user': self.user_names.get(uid, ''), 'versions': count} for uid, count in self.users.top(STATS_TOP)],
+            'changesets': len(self.changesets),
+            'top_changesets': [{'changeset': changeset, 'versions': count} for changeset, count in self.changesets.top(STATS_TOP)],
+            'bbox': self.bbox,
+        }
+
+def dayName(day):
+    return date.fromordinal(EPOCH_ORDINAL + int(day)).isoformat()
+
+class EntityStats(object):
+    """statistics of the versions of one entity type, counted like
+    Importer.add but without building any row.
+
+    Versions are kept in arrays and aggregated with NumPy by batches of
+    STATS_BATCH_SIZE."""
+
+    def __init__(self, datatype, file_stats):
+        self.datatype = datatype
+        self.file_stats = file_stats
+        self.columns()
+        # Versions by state: added, modified, deleted
+        self.states = np.zeros(3, dtype=np.int64)
+        # Entities by number of versions
+        self.versions = np.zeros(0, dtype=np.int64)
+        # Versions of the last entity of the previous batch, which can go on
+        self.last_id = None
+        self.last_versions = 0
+        # Versions per entity are only counted when ids never go backwards
+        self.unsorted = False
+
+    def columns(self):
+        self.ids = array('q')
+        self.state = array('b')
+        self.days = array('q')
+        self.uids = array('q')
+        self.changesets = array('q')
+        self.x = array('i')
+        self.y = array('i')
+
+    # Deal with one entity (node, way or relation)
+    def add(self, o):
+        if o.deleted:
+            self.state.append(2)
+        elif o.version == 1:
+            self.state.append(0)
+        else:
+            self.state.append(1)
+        self.ids.append(o.id)
+        self.days.append(int(o.timestamp.timestamp()) // 86400)
+        self.uids.append(o.uid)
+        self.changesets.append(o.changeset)
+        if o.uid not in self.file_stats.user_names:
+            self.file_stats.user_names[o.uid] = o.user
+        if self.datatype == NODE_TYPE:
+            location = o.location
+            self.x.append(location.x)
+            self.y.append(location.y)
+        if len(self.ids) >= STATS_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.ids) == 0:
+            return
+        self.states += np.bincount(np.frombuffer(self.state, dtype=np.int8), minlength=3)
+        self.countVersions(np.frombuffer(self.ids, dtype=np.int64))
+        self.file_stats.add(np.frombuffer(self.days, dtype=np.int64), np.frombuffer(self.uids, dtype=np.int64),
+            np.frombuffer(self.changesets, dtype=np.int64))
+        if self.datatype == NODE_TYPE:
+            self.file_stats.addLocations(np.frombuffer(self.x, dtype=np.int32), np.frombuffer(self.y, dtype=np.int32))
+        self.columns()
+
+    # Count the versions of each entity, from the runs of ids (versions of
+    # an entity follow each other in history files). Unsorted files, such as
+    # merged ones, are detected and their versions per entity not counted.
+    def countVersions(self, ids):
+        if self.unsorted:
+            return
+        if (self.last_id != None and ids[0] < self.last_id) or np.any(ids[1:] < ids[:-1]):
+            self.unsorted = True
+            self.versions = np.zeros(0, dtype=np.int64)
+            return
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        lengths = np.diff(np.r_[starts, len(ids)])
+        if ids[0] == self.last_id:
+            lengths[0] += self.last_versions
+        elif self.last_id != None:
+            self.versions = addCounts(self.versions, np.bincount([self.last_versions]))
+        self.versions = addCounts(self.versions, np.bincount(lengths[:-1]))
+        self.last_id = int(ids[-1])
+        self.last_versions = int(lengths[-1])
+
+    def finish(self):
+        self.flush()
+        if self.last_id != None and not self.unsorted:
+            self.versions = addCounts(self.versions, np.bincount([self.last_versions]))
+            self.last_id = None
+
+    # Print stats of the versions found
+    def outstats(self):
+        print("%s added: %d" % (self.datatype, self.states[0]))
+        print("%s modified: %d" % (self.datatype, self.states[1]))
+        print("%s deleted: %d" % (self.datatype, self.states[2]))
+        if self.unsorted:
+            print('\033[93m'+"%s are not sorted by id, versions per entity not counted." % self.datatype+'\033[0m')
+            return
+        entities = self.versions.sum()
+        if entities > 0:
+            counts = np.arange(len(self.versions))
+            print("%s entities: %d, %.2f versions each, %d at most" % (self.datatype, entities,
+                (counts*self.versions).sum()/entities, len(self.versions)-1))
+            for count in np.flatnonzero(self.versions)[:STATS_TOP]:
+                print("  %d versions: %d" % (count, self.versions[count]))
+
+    def json(self):
+        return {
+            'added': int(self.states[0]),
+            'modified': int(self.states[1]),
+            'deleted': int(self.states[2]),
+            # None when the file is not sorted by id
+            'entities_by_versions': None if self.unsorted else {int(count): int(self.versions[count]) for count in np.flatnonzero(self.versions)},
+        }
+
+class FileSummaryHandler(o.SimpleHandler):
+    """statistics-only counterpart of FileStatsHandler: nothing is
+    serialized nor written."""
+
+    def __init__(self):
+        super(FileSummaryHandler, self).__init__()
+        self.file_stats = FileStats()
+        self.nodes = EntityStats(NODE_TYPE, self.file_stats)
+        self.ways = EntityStats(WAY_TYPE, self.file_stats)
+        self.rels = EntityStats(RELATION_TYPE, self.file_stats)
 
+    def node(self, n):
+        self.nodes.add(n)
+
+    def way(self, w):
+        self.ways.add(w)
+
+    def relation(self, r):
+        self.rels.add(r)
+
+    def finish(self):
+        self.nodes.finish()
+        self.ways.finish()
+        self.rels.finish()
+
+    def json(self):
+        stats = {'nodes': self.nodes.json(), 'ways': self.ways.json(), 'relations': self.rels.json()}
+        stats.update(self.file_stats.json())
+        return stats
+
+# Extract "--name" or "--name=value" from the command line arguments
+def getOption(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg == '--'+name:
+            sys.argv.remove(arg)
+            return True
+        if arg.startswith('--'+name+'='):
+            sys.argv.remove(arg)
+            return arg.split('=',1)[1]
+    return default
 
 if __name__ == '__main__':
     white = '\033[0m'
@@ -247,35 +757,98 @@ if __name__ == '__main__':
     print("=================================")
 
 
+    # Options: --copy (COPY text format) or --copy=binary,
+    # --stream[=<MB>] to write while parsing with a memory ceiling (256MB by default),
+    # --stats[=<json file>] to only compute statistics of the file, without database
+    copy_mode = getOption('copy')
+    stream_mode = getOption('stream')
+    stats_mode = getOption('stats')
+
     if len(sys.argv) != 2:
-        print("Usage: python osm-importer.py <osmfile>")
+        print("Usage: python osm-importer.py <osmfile> [--copy[=binary]] [--stream[=<MB>]] [--stats[=<json file>]]")
         sys.exit(-1)
 
-    print(orange+"\nWarning: All single quote ' are deleted in tags and users'name"+white)
+    if stats_mode:
+        if copy_mode or stream_mode:
+            print('\033[91m'+"--stats doesn't write anything, it can't be used with --copy or --stream."+'\033[0m')
+            sys.exit(-1)
+        if np == None:
+            print('\033[91m'+"--stats needs NumPy."+'\033[0m')
+            sys.exit(-1)
+
+        print("Parsing file... ",end='')
+        h = FileSummaryHandler()
+        h.apply_file(sys.argv[1])
+        h.finish()
+        print("OK")
+
+        print("\nData found:")
+
+        h.nodes.outstats()
+        h.ways.outstats()
+        h.rels.outstats()
+        h.file_stats.outstats()
+
+        if stats_mode != True:
+            file = open(stats_mode, "w")
+            json.dump(h.json(), file, indent=2)
+            file.close()
+            print("Statistics saved in "+stats_mode)
+        sys.exit(0)
 
     # Create connection with db and file importer
     print("\nConnecting to db... ",end='')
     db = DB()
+    if copy_mode:
+        writer = CopyWriter(db, binary=(copy_mode == 'binary'))
+    else:
+        writer = InsertWriter(db)
     print("OK")
 
-    # Parse file
-    print("Parsing file... ",end='')
-    h = FileStatsHandler(db)
-    h.apply_file(sys.argv[1])
-    print("OK")
-
-    print("\nData found:")
+    if stream_mode:
+        max_memory = 256 if stream_mode == True else int(stream_mode)
+        queue = RowQueue(max_memory*1024*1024)
+        stream = StreamWriter(queue, writer)
+        stream.start()
 
-    h.nodes.outstats()
-    h.ways.outstats()
-    h.rels.outstats()
-
-    print("Starting nodes import...")
-    h.nodes.executeImport()
-    print("Starting ways import...")
-    h.ways.executeImport()
-    print("Starting relations import...")
-    h.rels.executeImport()
-    print("OK")
+        # Parse file and import it at the same time
+        print("Parsing and importing file... ",end='')
+        h = FileStatsHandler(writer, queue)
+        try:
+            h.apply_file(sys.argv[1])
+            h.finish_stream()
+        finally:
+            queue.close()
+            stream.join()
+        if stream.failed:
+            sys.exit(-1)
+        print("OK")
+
+        print("\nData imported:")
+
+        h.nodes.outstats()
+        h.ways.outstats()
+        h.rels.outstats()
+        print("Rows written: %d" % stream.written)
+    else:
+        # Parse file
+        print("Parsing file... ",end='')
+        h = FileStatsHandler(writer)
+        h.apply_file(sys.argv[1])
+        print("OK")
+
+        print("\nData found:")
+
+        h.nodes.outstats()
+        h.ways.outstats()
+        h.rels.outstats()
+
+        print("Starting nodes import...")
+        h.nodes.executeImport()
+        print("Starting ways import...")
+        h.ways.executeImport()
+        print("Starting relations import...")
+        h.rels.executeImport()
+        print("OK")
 
     print(green+"Import successful!"+white)
@@ -9,15 +9,30 @@ Simply modify the DB variables, and run using:
 import osmium as o
 import sys
 import os
-from datetime import date
+import io
+import struct
+from datetime import date, datetime, timezone
 import time
 import psycopg2
+import sqlite3
+from psycopg2.pool import ThreadedConnectionPool
+import numpy as np
 # import pprint
 import json
-
+import pickle
+import tempfile
+import atexit
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import chain, groupby
+from functools import partial
+from collections import deque
+from threading import Thread, Condition, Lock, Event
 from queue import Queue
-from threading import Thread, Lock
-from multiprocessing import Process,Manager
+
+from multiprocessing import get_context
 
 DB_NAME='osmmonaco'
 DB_USER='Julien'
@@ -29,37 +44,13 @@ NODE_TYPE="Nodes"
 WAY_TYPE="Ways"
 RELATION_TYPE="Relations"
 
-BOTTOM_LEFT_BOUNDARY=[0,0]
-TOP_RIGHT_BOUNDARY=[0,0]
-
-nodes_discarded = 0
-ways_discarded = 0
-relations_discarded = 0
-
-nodes_added = 0
-ways_added = 0
-relations_added = 0
-
-actionsLogged = 0
-lastActionLogged = 0
-
-class DB(object):
-    """encaspulate a database connection."""
-
-    def __init__(self):
-        try:
-            self.connection = psycopg2.connect("dbname='"+DB_NAME+"' user='"+DB_USER+"' password='"+DB_PWD+"' host='"+DB_HOST+"' port='"+DB_PORT+"'")
-        except:
-            print('\033[91m'+"Unable to connect to the database."+'\033[0m')
-            sys.exit(-1)
-
-        self.createTables()
-
+# Tables in the order they have to be loaded (parents before children)
+TABLES=['nodes','ways','ways_nodes','relations','relations_members']
+# Entities stored in each table, by their order in history files
+TABLE_RANKS={'nodes':0,'ways':1,'ways_nodes':1,'relations':2,'relations_members':2}
 
-    def createTables(self):
-        commands = [
-        """
-        CREATE TABLE IF NOT EXISTS nodes (
+TABLE_COLUMNS = {
+    'nodes': """
             id BIGINT NOT NULL,
             deleted BOOLEAN NOT NULL,
             visible BOOLEAN NOT NULL,
@@ -70,11 +61,8 @@ class DB(object):
             user_name VARCHAR(255) NOT NULL,
             latitude INT NOT NULL,
             longitude INT NOT NULL,
-            tags json NOT NULL,
-            PRIMARY KEY (id, version)
-        )
-        """,
-        """CREATE TABLE IF NOT EXISTS ways (
+            tags json NOT NULL""",
+    'ways': """
             id BIGINT NOT NULL,
             deleted BOOLEAN NOT NULL,
             visible BOOLEAN NOT NULL,
@@ -83,23 +71,16 @@ class DB(object):
             uniqueid BIGINT NOT NULL,
             created_at TIMESTAMP NOT NULL,
             user_name VARCHAR(255) NOT NULL,
-            tags json NOT NULL,
-            PRIMARY KEY (id, version)
-        )
-        """,
-        """CREATE TABLE IF NOT EXISTS ways_nodes (
+            tags json NOT NULL""",
+    'ways_nodes': """
             id BIGINT NOT NULL,
             version BIGINT NOT NULL,
             node_id BIGINT NOT NULL,
             node_version BIGINT NOT NULL,
             sequence_id BIGINT NOT NULL,
             latitude INT NOT NULL,
-            longitude INT NOT NULL,
-            foreign key (id,version) references ways(id,version),
-            PRIMARY KEY (id,version,sequence_id,node_id,node_version)
-        )
-        """,
-        """CREATE TABLE IF NOT EXISTS relations (
+            longitude INT NOT NULL""",
+    'relations': """
             id BIGINT NOT NULL,
             deleted BOOLEAN NOT NULL,
             visible BOOLEAN NOT NULL,
@@ -108,382 +89,2833 @@ class DB(object):
             uniqueid BIGINT NOT NULL,
             created_at TIMESTAMP NOT NULL,
             user_name VARCHAR(255) NOT NULL,
-            tags json NOT NULL,
-            PRIMARY KEY (id, version)
-        )
-        """,
-        """CREATE TABLE IF NOT EXISTS relations_members (
+            tags json NOT NULL""",
+    'relations_members': """
             id BIGINT NOT NULL,
             version BIGINT NOT NULL,
             member_id BIGINT NOT NULL,
             member_type CHAR(1) NOT NULL,
             member_role VARCHAR(255),
-            sequence_id BIGINT NOT NULL,
-            foreign key (id,version) references relations(id,version),
-            PRIMARY KEY (id,version,sequence_id)
-        )
-        """,]
+            sequence_id BIGINT NOT NULL""",
+    'users': """
+            id INT NOT NULL,
+            user_name VARCHAR(255) NOT NULL""",
+    'tag_keys': """
+            id INT NOT NULL,
+            key TEXT NOT NULL""",
+    'tag_values': """
+            id INT NOT NULL,
+            value TEXT NOT NULL""",
+    'ways_geometries': """
+            id BIGINT NOT NULL,
+            version BIGINT NOT NULL,
+            geometry BYTEA NOT NULL""",
+}
+
+PRIMARY_KEYS = {
+    'nodes': "(id, version)",
+    'ways': "(id, version)",
+    'ways_nodes': "(id,version,sequence_id,node_id,node_version)",
+    'relations': "(id, version)",
+    'relations_members': "(id,version,sequence_id)",
+    'users': "(id)",
+    'tag_keys': "(id)",
+    'tag_values': "(id)",
+    'ways_geometries': "(id, version)",
+}
+
+# Foreign keys of each table: (columns, parent table)
+FOREIGN_KEYS = {
+    'ways_nodes': [("(id,version)", 'ways')],
+    'relations_members': [("(id,version)", 'relations')],
+    'ways_geometries': [("(id,version)", 'ways')],
+}
+
+# Bulk load mode: load into unlogged staging tables without any constraint,
+# then build keys and swap them with the final tables at the end
+BULK_LOAD = False
+BULK_MAINTENANCE_WORK_MEM = '1GB'
+BULK_SESSION = ["SET synchronous_commit TO off", "SET maintenance_work_mem TO '"+BULK_MAINTENANCE_WORK_MEM+"'"]
+
+# Resume mode: continue an interrupted import after its last checkpoint
+RESUME = False
+CHECKPOINT_TABLE = 'import_checkpoint'
+
+# Rows (or statements) failing are skipped and saved in this table with
+# their error, the rest of their batch is committed (see isolateFailures)
+REJECT_TABLE = 'import_rejects'
+# Statements sent at once by DB.execute
+EXECUTE_BATCH_SIZE = 1000
+
+# Column types used to encode rows for COPY ... (FORMAT binary):
+# q=bigint, i=int, b=boolean, t=timestamp, s=text/varchar/char/json, a=int[],
+# y=bytea
+COPY_TYPES = {
+    'nodes': 'qbbqqqtsiis',
+    'ways': 'qbbqqqtss',
+    'ways_nodes': 'qqqqqii',
+    'relations': 'qbbqqqtss',
+    'relations_members': 'qqqssq',
+    'users': 'is',
+    'tag_keys': 'is',
+    'tag_values': 'is',
+    'ways_geometries': 'qqy',
+}
+
+# Normalized mode: user names, tag keys and tag values are stored once in
+# dictionary tables, entities reference them by id (see normalizeTables)
+NORMALIZE = False
+DICTIONARY_TABLES = ['users', 'tag_keys', 'tag_values']
+
+# Geometries mode: the line of each way version is also stored as WKB
+# in the ways_geometries table (see addGeometry)
+GEOMETRIES = False
+
+# Ways sent to the worker pool at once
+WORKER_BATCH_SIZE=1000
+# Nodes filtered against the zone at once
+NODE_BATCH_SIZE=65536
+# PBF blocks decoded at once by a worker when reading in parallel
+READ_BLOCKS_PER_TASK=8
+# Batches waiting to be loaded by a PipelineWriter
+PIPELINE_DEPTH=2
+# Bytes read at once from a batch by COPY: loaders run in threads,
+# and each read takes the GIL
+COPY_READ_SIZE=1048576
+# Records sorted in memory by the sort-merge resolver before being spilled
+SORT_RUN_SIZE=2000000
+# Directory of the spill files (the system temporary directory by default)
+SPILL_DIR=None
+# Bytes of entities held in memory by --sort before a run is spilled
+SORT_MEMORY=256*1024*1024
+
+BOTTOM_LEFT_BOUNDARY=[0,0]
+TOP_RIGHT_BOUNDARY=[0,0]
+# Zone given as polygons instead of the boundaries (see PolygonZone)
+ZONE_POLYGON=None
+# Cells per side of the grid index of a polygon zone
+POLYGON_GRID_SIZE=256
+# Strips of each row of cells, for the exact tests
+POLYGON_STRIPS_PER_ROW=16
+# (point, edge) pairs tested at once against a polygon zone
+RAY_CAST_PAIRS=1000000
+
+# Time window of the imported versions, in seconds since the epoch: versions
+# created before SINCE or at or after UNTIL are dropped (see inWindow)
+SINCE=None
+UNTIL=None
+
+# Seconds between two snapshots of the metrics
+METRICS_INTERVAL=10
+
+# Rows per file written by the csv sink before starting a new one
+CSV_PARTITION_ROWS=1000000
+
+# Statement creating a final table with its keys
+def createTableCommand(table):
+    constraints = [",\n            PRIMARY KEY "+PRIMARY_KEYS[table]]
+    for columns, parent in FOREIGN_KEYS.get(table, []):
+        constraints.append(",\n            foreign key "+columns+" references "+parent+columns)
+    return "CREATE TABLE IF NOT EXISTS "+table+" ("+TABLE_COLUMNS[table]+"".join(constraints)+"\n        )"
 
+class DB(object):
+    """encaspulate a database connection."""
+
+    def __init__(self, name=None, schema=None):
+        self.dsn = "dbname='"+(name or DB_NAME)+"' user='"+DB_USER+"' password='"+DB_PWD+"' host='"+DB_HOST+"' port='"+DB_PORT+"'"
+        # Every connection (pooled ones too) creates and reads the tables in the schema
+        if schema != None:
+            self.dsn += " options='-c search_path="+schema+"'"
+        try:
+            self.connection = psycopg2.connect(self.dsn)
+        except:
+            print('\033[91m'+"Unable to connect to the database "+(name or DB_NAME)+"."+'\033[0m')
+            sys.exit(-1)
+        # Statements failing are only saved once the rejects table is created
+        self.rejects = False
+        if schema != None:
+            self.execute(["CREATE SCHEMA IF NOT EXISTS "+schema])
+
+        # Staging tables are loaded in bulk load mode
+        self.tables = dict((table, table+"_staging" if BULK_LOAD else table) for table in TABLES)
+
+        self.createTables()
+
+
+    def createTables(self):
+        commands = []
+        for table in TABLES:
+            if BULK_LOAD and RESUME:
+                # Staging tables of the interrupted import are kept
+                commands.append("CREATE UNLOGGED TABLE IF NOT EXISTS "+self.tables[table]+" ("+TABLE_COLUMNS[table]+"\n        )")
+            elif BULK_LOAD:
+                # No constraint at all, they are built at the end of the import
+                commands.append("DROP TABLE IF EXISTS "+self.tables[table])
+                commands.append("CREATE UNLOGGED TABLE "+self.tables[table]+" ("+TABLE_COLUMNS[table]+"\n        )")
+            else:
+                commands.append(createTableCommand(table))
+
+        commands.append("""CREATE TABLE IF NOT EXISTS """+CHECKPOINT_TABLE+""" (
+            id SMALLINT NOT NULL,
+            file_name TEXT NOT NULL,
+            phase VARCHAR(16) NOT NULL,
+            entity_type CHAR(1),
+            entity_id BIGINT,
+            entity_version BIGINT,
+            counters json NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (id)
+        )""")
+        commands.append("""CREATE TABLE IF NOT EXISTS """+REJECT_TABLE+""" (
+            table_name VARCHAR(32),
+            row_data TEXT NOT NULL,
+            error TEXT NOT NULL,
+            rejected_at TIMESTAMP NOT NULL
+        )""")
         self.execute(commands)
+        self.rejects = True
 
-    def execute(self,commands=[]):
-        for command in commands:
+    # Session settings making a bulk load faster
+    def setBulkSession(self):
+        self.execute(BULK_SESSION)
+
+    # Pool of other connections to the same database
+    def connectionPool(self, size):
+        try:
+            return ThreadedConnectionPool(size, size, self.dsn)
+        except:
+            print('\033[91m'+"Unable to open "+str(size)+" connections to the database."+'\033[0m')
+            sys.exit(-1)
+
+    # Build keys on the staging tables and swap them with the final tables
+    def finalizeBulkLoad(self):
+        steps = []
+        for table in TABLES:
+            steps.append(("Logging "+table, ["ALTER TABLE "+self.tables[table]+" SET LOGGED"]))
+        for table in TABLES:
+            steps.append(("Primary key of "+table, ["ALTER TABLE "+self.tables[table]+" ADD CONSTRAINT "+table+"_staging_pkey PRIMARY KEY "+PRIMARY_KEYS[table]]))
+        for table in TABLES:
+            for columns, parent in FOREIGN_KEYS.get(table, []):
+                steps.append(("Foreign key of "+table+" to "+parent, ["ALTER TABLE "+self.tables[table]+" ADD CONSTRAINT "+table+"_staging_fkey FOREIGN KEY "+columns+" REFERENCES "+self.tables[parent]+columns]))
+        for table in TABLES:
+            steps.append(("Analyzing "+table, ["ANALYZE "+self.tables[table]]))
+
+        # The final tables are replaced in a single transaction
+        swap = ["DROP TABLE IF EXISTS "+", ".join(reversed(TABLES))+" CASCADE"]
+        for table in TABLES:
+            swap.append("ALTER TABLE "+self.tables[table]+" RENAME TO "+table)
+            swap.append("ALTER TABLE "+table+" RENAME CONSTRAINT "+table+"_staging_pkey TO "+table+"_pkey")
+            if table in FOREIGN_KEYS:
+                swap.append("ALTER TABLE "+table+" RENAME CONSTRAINT "+table+"_staging_fkey TO "+table+"_id_version_fkey")
+        steps.append(("Swapping tables", swap))
+
+        for name, commands in steps:
+            step_time = time.time()
             try:
                 cur = self.connection.cursor()
-
-                cur.execute(command)
+                for command in commands:
+                    cur.execute(command)
                 cur.close()
+                self.connection.commit()
             except (Exception, psycopg2.DatabaseError) as error:
                 print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
-                print('Ignoring error...')
+                print("Staging tables are left in place.")
+                sys.exit(-1)
+            metrics.time('finalize.'+name, time.time()-step_time)
+            logStep(name+": "+str(round(time.time()-step_time, 3))+"s")
+
+        self.tables = dict((table, table) for table in TABLES)
+
+    # Run the statements in one transaction. If it fails, it is run again
+    # with the statements failing isolated and ignored (see isolateFailures),
+    # tables giving the table of each statement to save them in the rejects
+    # table. Return the number of statements rejected, or None if all of
+    # them were discarded.
+    def execute(self,commands=[],tables=None):
+        if len(commands) == 0:
+            return 0
+        rejected = 0
+        cur = self.connection.cursor()
+        try:
+            for i in range(0, len(commands), EXECUTE_BATCH_SIZE):
+                executeStatements(cur, commands[i:i+EXECUTE_BATCH_SIZE])
+        except (Exception, psycopg2.DatabaseError):
+            self.connection.rollback()
+            if tables == None:
+                tables = [None]*len(commands)
+            try:
+                rejected = isolateFailures(cur, list(zip(tables, commands)), executeTableStatements, self.rejectStatement)
+            except (Exception, psycopg2.DatabaseError) as error:
+                print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+                print('Ignoring error, '+str(len(commands))+' statements discarded...')
                 self.connection.rollback()
-                # sys.exit(-1)
-            else:
-                # commit the changes
-                self.connection.commit()
+                rejected = None
+        cur.close()
+        # commit the changes
+        self.connection.commit()
+        return rejected
+
+    # Save a statement given with its table, None if it is not a row
+    def rejectStatement(self, cur, item, error):
+        table, statement = item
+        print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+        print('Ignoring error...')
+        if self.rejects:
+            rejectItem(cur, statement, error, table)
 
     def executeAndReturn(self,command):
         try:
             cur = self.connection.cursor()
-            # create table one by one
             cur.execute(command)
-
             result = cur.fetchone()
-            # close communication with the PostgreSQL database server
             cur.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+            sys.exit(-1)
+        self.connection.commit()
+        return result
+
+# ============= Row writers ==============
 
-            # commit the changes
+# Importers write rows into a writer (the output sink) with add(table, row),
+# rows being tuples of Python values in the order of TABLE_COLUMNS. flush()
+# writes the rows added so far, sync() also waits for them to be visible to
+# the database, close() ends the import. Writers having their rows in a
+# PostgreSQL database save the checkpoint attribute along with them.
+
+class InsertWriter(object):
+    """write rows as one INSERT statement per row."""
+
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+        # Table of each command, saved with the rows rejected
+        self.tables = []
+        self.pending = 0
+        self.checkpoint = None
+
+    def add(self, table, row):
+        self.commands.append("INSERT INTO "+self.db.tables[table]+" VALUES ("+",".join(sqlValue(v) for v in row)+");")
+        self.tables.append(table)
+        self.pending += 1
+
+    def flush(self):
+        if self.checkpoint != None:
+            self.commands.append(self.checkpoint.command())
+            self.tables.append(None)
+        flush_time = time.time()
+        rejected = self.db.execute(self.commands, self.tables)
+        metrics.time('db_flush', time.time()-flush_time)
+        countLoaded(self.pending, rejected)
+        self.commands = []
+        self.tables = []
+        self.pending = 0
+
+    # Everything is written once flushed
+    def sync(self):
+        self.flush()
+
+    def close(self):
+        pass
+
+class CopyWriter(object):
+    """buffer rows per table and stream them with COPY ... FROM STDIN."""
+
+    def __init__(self, db, binary=False):
+        self.db = db
+        self.binary = binary
+        self.pending = 0
+        self.checkpoint = None
+        self.buffers = {}
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if binary else io.StringIO()
+
+    def add(self, table, row):
+        if self.binary:
+            self.buffers[table].write(copyBinaryRow(COPY_TYPES[table], row))
+        else:
+            self.buffers[table].write('\t'.join(copyTextValue(v) for v in row)+'\n')
+        self.pending += 1
+
+    def flush(self):
+        if self.pending == 0 and self.checkpoint == None:
+            return
+        countLoaded(self.pending, self.load(self.db.connection, self.batch()))
+
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if self.binary else io.StringIO()
+        self.pending = 0
+
+    # Encoded rows of each table, the checkpoint command and the number of rows
+    def batch(self):
+        data = dict((table, self.buffers[table].getvalue()) for table in TABLES)
+        return (data, self.checkpoint.command() if self.checkpoint != None else None, self.pending)
+
+    # Load a batch in one transaction. If it fails, it is loaded again with
+    # the rows failing saved in the rejects table instead. Return the number
+    # of rows rejected, or None if the batch was discarded.
+    def load(self, connection, batch):
+        data, checkpoint, rows = batch
+        flush_time = time.time()
+        cur = connection.cursor()
+        try:
+            rejected = self.copyBatch(cur, data, checkpoint, False)
+        except (Exception, psycopg2.DatabaseError) as error:
+            print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+            connection.rollback()
+            try:
+                rejected = self.copyBatch(cur, data, checkpoint, True)
+            except (Exception, psycopg2.DatabaseError) as error:
+                print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+                print('Ignoring error, '+str(rows)+' rows discarded...')
+                connection.rollback()
+                rejected = None
+            else:
+                print('Ignoring error, '+str(rejected)+' rows saved in '+REJECT_TABLE+'...')
+        if rejected != None:
+            connection.commit()
+        cur.close()
+        metrics.time('db_flush', time.time()-flush_time)
+        return rejected
+
+    # Copy a batch in the current transaction, isolating the rows failing
+    # when asked to. Return the number of rows rejected.
+    def copyBatch(self, cur, data, checkpoint, isolate):
+        rejected = 0
+        # Parents are loaded first so that foreign keys are satisfied
+        for table in TABLES:
+            if len(data[table]) == 0:
+                continue
+            if isolate:
+                rejected += copyIsolating(cur, table, self.db.tables[table], data[table], self.binary)
+            else:
+                copyData(cur, self.db.tables[table], data[table], self.binary)
+        # Saved in the same transaction, so it matches the committed rows
+        if checkpoint != None:
+            cur.execute(checkpoint)
+        return rejected
+
+    # Everything is written once flushed
+    def sync(self):
+        self.flush()
+
+    def close(self):
+        pass
+
+# Count the rows of a batch once loaded, rejected being the number of rows
+# saved in the rejects table, or None if the whole batch was discarded
+def countLoaded(rows, rejected):
+    if rejected == None:
+        metrics.count('rows_discarded', rows)
+        return
+    metrics.count('rows_written', rows - rejected)
+    if rejected > 0:
+        metrics.count('rows_rejected', rejected)
+
+class PipelineWriter(CopyWriter):
+    """CopyWriter loading its batches in a thread, on a connection of its
+    own, while the next batch is being parsed, filtered and encoded.
+
+    Batches are handed over through a bounded queue: flush() only waits
+    when PIPELINE_DEPTH batches are already waiting to be loaded, so the
+    import takes about the longest of parsing and loading, not their sum."""
+
+    def __init__(self, db, binary=False):
+        super(PipelineWriter, self).__init__(db, binary)
+        try:
+            self.connection = psycopg2.connect(db.dsn)
+        except:
+            print('\033[91m'+"Unable to open a second connection to the database."+'\033[0m')
+            sys.exit(-1)
+        if BULK_LOAD:
+            cur = self.connection.cursor()
+            for command in BULK_SESSION:
+                cur.execute(command)
+            cur.close()
             self.connection.commit()
+        self.batches = Queue(maxsize=PIPELINE_DEPTH)
+        self.failed = False
+        self.loader = Thread(target=self.run)
+        # The import can stop while the loader waits for batches
+        self.loader.daemon = True
+        self.loader.start()
+
+    def flush(self):
+        if self.pending == 0 and self.checkpoint == None:
+            return
+        self.checkFailure()
+        wait_time = time.time()
+        # Blocks while the loader is PIPELINE_DEPTH batches behind
+        self.batches.put(self.batch())
+        metrics.time('pipeline_wait', time.time()-wait_time)
+
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if self.binary else io.StringIO()
+        self.pending = 0
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch == None:
+                    break
+                # After a failure, batches are only taken out of the queue
+                # so that the import does not wait for this thread
+                if not self.failed:
+                    countLoaded(batch[2], self.load(self.connection, batch))
+            except BaseException as error:
+                print('\033[91m'+"\nERROR while loading:\n"+str(error)+'\033[0m')
+                self.failed = True
+            finally:
+                self.batches.task_done()
+
+    def checkFailure(self):
+        if self.failed:
+            print('\033[91m'+"\nERROR: the loader stopped."+'\033[0m')
+            sys.exit(-1)
 
-            return result
+    # Wait for every batch flushed so far to be loaded
+    def sync(self):
+        self.flush()
+        self.batches.join()
+        self.checkFailure()
+
+    def close(self):
+        self.sync()
+        self.batches.put(None)
+        self.loader.join()
+        self.connection.close()
+
+class TableLoader(Thread):
+    """load the batches of one table with COPY on a dedicated connection."""
+
+    def __init__(self, writer, table, connection):
+        Thread.__init__(self)
+        # The import can stop while loaders wait for batches
+        self.daemon = True
+        self.writer = writer
+        self.table = table
+        self.connection = connection
+        self.batches = Queue(maxsize=2)
+        # Last batch committed (or discarded after an error)
+        self.loaded = 0
+        self.failed = False
+
+    def run(self):
+        try:
+            cur = self.connection.cursor()
+            if BULK_LOAD:
+                for command in BULK_SESSION:
+                    cur.execute(command)
+                self.connection.commit()
+            while True:
+                generation, data, rows = self.batches.get()
+                if data == None:
+                    break
+                self.writer.waitForParent(self.table, generation)
+                if rows > 0:
+                    countLoaded(rows, self.load(cur, data, rows))
+                self.writer.setLoaded(self, generation)
+            cur.close()
+        except BaseException as error:
+            print('\033[91m'+"\nERROR while loading "+self.table+":\n"+str(error)+'\033[0m')
+            self.failed = True
+            # Do not leave the other loaders, nor the import, waiting for this one
+            self.writer.setLoaded(self, sys.maxsize)
+            while self.batches.get()[1] != None:
+                pass
+
+    # Load a batch, return the number of rows rejected or None if the
+    # batch was discarded (see CopyWriter.load)
+    def load(self, cur, data, rows):
+        table = self.writer.db.tables[self.table]
+        load_time = time.time()
+        rejected = 0
+        try:
+            copyData(cur, table, data, self.writer.binary)
         except (Exception, psycopg2.DatabaseError) as error:
             print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+            self.connection.rollback()
+            try:
+                rejected = copyIsolating(cur, self.table, table, data, self.writer.binary)
+            except (Exception, psycopg2.DatabaseError) as error:
+                print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
+                print('Ignoring error, '+str(rows)+' rows of '+self.table+' discarded...')
+                self.connection.rollback()
+                rejected = None
+            else:
+                print('Ignoring error, '+str(rejected)+' rows of '+self.table+' saved in '+REJECT_TABLE+'...')
+                self.connection.commit()
+        else:
+            self.connection.commit()
+        metrics.time('db_copy.'+self.table, time.time()-load_time)
+        return rejected
+
+class PoolWriter(object):
+    """buffer rows per table and load tables concurrently, each one with
+    its own connections taken from a pool.
+
+    Rows of a table are spread over its connections. A batch of a child
+    table (ways_nodes, relations_members) is loaded once the same batch of
+    its parent table is committed, so that foreign keys are satisfied."""
+
+    def __init__(self, db, binary=False, pool_size=len(TABLES)):
+        self.db = db
+        self.binary = binary
+        self.pending = 0
+        self.checkpoint = None
+        # Checkpoint of the last flush, saved once its batch is loaded everywhere
+        self.pending_checkpoint = None
+        self.generation = 0
+        self.condition = Condition()
+
+        self.pool = db.connectionPool(pool_size)
+        self.loaders = {}
+        self.buffers = {}
+        self.counts = {}
+        self.next = {}
+        for i, table in enumerate(TABLES):
+            # Connections left by the division go to the first tables
+            connections = pool_size // len(TABLES) + (1 if i < pool_size % len(TABLES) else 0)
+            self.loaders[table] = [TableLoader(self, table, self.pool.getconn()) for c in range(connections)]
+            self.next[table] = 0
+            self.resetBuffers(table)
+        for table in TABLES:
+            for loader in self.loaders[table]:
+                loader.start()
+
+    def resetBuffers(self, table):
+        self.buffers[table] = [io.BytesIO() if self.binary else io.StringIO() for loader in self.loaders[table]]
+        self.counts[table] = [0]*len(self.loaders[table])
+
+    def add(self, table, row):
+        i = self.next[table]
+        self.next[table] = (i + 1) % len(self.buffers[table])
+        if self.binary:
+            self.buffers[table][i].write(copyBinaryRow(COPY_TYPES[table], row))
+        else:
+            self.buffers[table][i].write('\t'.join(copyTextValue(v) for v in row)+'\n')
+        self.counts[table][i] += 1
+        self.pending += 1
+
+    def flush(self):
+        if self.pending == 0 and self.checkpoint == None:
+            return
+        self.checkFailures()
+        self.generation += 1
+        for table in TABLES:
+            for loader, buffer, rows in zip(self.loaders[table], self.buffers[table], self.counts[table]):
+                # Blocks while the loader is two batches behind
+                loader.batches.put((self.generation, buffer.getvalue(), rows))
+            self.resetBuffers(table)
+        self.pending = 0
+
+        self.saveCheckpoint(self.generation - 1)
+        if self.checkpoint != None:
+            self.pending_checkpoint = (self.generation, self.checkpoint.command())
+
+    # Save the checkpoint of the given batch once every table has loaded it
+    def saveCheckpoint(self, generation):
+        if self.pending_checkpoint == None or self.pending_checkpoint[0] > generation:
+            return
+        with self.condition:
+            while min(self.loaded(table) for table in TABLES) < generation:
+                self.condition.wait()
+        self.checkFailures()
+        self.db.execute([self.pending_checkpoint[1]])
+        self.pending_checkpoint = None
+
+    def checkFailures(self):
+        for table in TABLES:
+            for loader in self.loaders[table]:
+                if loader.failed:
+                    print('\033[91m'+"\nERROR: the loader of "+table+" stopped."+'\033[0m')
+                    sys.exit(-1)
+
+    # Last batch loaded by every connection of a table
+    def loaded(self, table):
+        return min(loader.loaded for loader in self.loaders[table])
+
+    def setLoaded(self, loader, generation):
+        with self.condition:
+            loader.loaded = generation
+            self.condition.notify_all()
+
+    def waitForParent(self, table, generation):
+        # Staging tables of the bulk load mode have no foreign key
+        if BULK_LOAD:
+            return
+        with self.condition:
+            for columns, parent in FOREIGN_KEYS.get(table, []):
+                while self.loaded(parent) < generation:
+                    self.condition.wait()
+
+    # Wait for every batch flushed so far to be loaded
+    def sync(self):
+        self.flush()
+        with self.condition:
+            while min(self.loaded(table) for table in TABLES) < self.generation:
+                self.condition.wait()
+        self.checkFailures()
+
+    # Wait for every batch to be loaded and release the connections
+    def close(self):
+        self.flush()
+        for table in TABLES:
+            for loader in self.loaders[table]:
+                loader.batches.put((None, None, 0))
+        for table in TABLES:
+            for loader in self.loaders[table]:
+                loader.join()
+                self.pool.putconn(loader.connection)
+        self.checkFailures()
+        self.saveCheckpoint(self.generation)
+        self.pool.closeall()
+
+class SQLiteWriter(object):
+    """write rows into a SQLite database file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+        self.checkpoint = None
+        self.rows = dict((table, []) for table in TABLES)
+        try:
+            self.connection = sqlite3.connect(path)
+            # The file is rewritten, like the staging tables of a bulk load
+            for table in reversed(TABLES):
+                self.connection.execute("DROP TABLE IF EXISTS "+table)
+            for table in TABLES:
+                self.connection.execute(createTableCommand(table))
+            self.connection.commit()
+        except sqlite3.Error as error:
+            print('\033[91m'+"Unable to create the tables in "+path+": "+str(error)+'\033[0m')
             sys.exit(-1)
+        self.inserts = dict((table, "INSERT INTO "+table+" VALUES ("+",".join("?"*len(COPY_TYPES[table]))+")") for table in TABLES)
 
-class WayNodeChecker(Thread):
-    # Appending item to list is a thread-safe operation
-   def __init__(self, queue, queries, seq_id,db,way):
-       Thread.__init__(self)
-       self.queue = queue
-       self.queries = queries
-       self.seq_id = seq_id
-       self.db = db
-       self.way = way
-
-   def run(self):
-       node_way_query = """ INSERT INTO ways_nodes VALUES ({0}, {1}, {2}, {3},{4},{5},{6}) """
-
-       while True:
-           # Get the work from the queue
-           item = self.queue.get()
-           logAction("Testing node for a way, node_id: "+str(item.ref))
-
-           node_query = """SELECT * from nodes where id = {0} and created_at<='{1}' order by created_at desc limit 1;"""
-           current_node = self.executeSearchCommand(node_query.format(item.ref,self.way.timestamp))
-           if current_node == None:
-               node_query = """SELECT * from nodes where id = {0} order by created_at limit 1;"""
-               current_node = self.executeSearchCommand(node_query.format(item.ref,self.way.timestamp))
-
-           # filter out way if no o.nodes dans la zoe
-           if current_node == None:
-               logAction("Discarding a node from a way, node_id: "+str(item.ref))
-               self.queue.task_done()
-               continue
-
-           logAction("Adding node to a way, node_id: "+str(item.ref))
-           self.queries.append( node_way_query.format(self.way.id,self.way.version,item.ref,current_node[len(current_node)-8],self.seq_id.getValue(),current_node[len(current_node)-3],current_node[len(current_node)-2]) )
-           self.seq_id.increment()
-           self.queue.task_done()
-
-   def executeSearchCommand(self,command):
-         return self.db.executeAndReturn(command)
-
-class RelationMemberChecker(Thread):
-    # Appending item to list is a thread-safe operation
-   def __init__(self, queue, queries, seq_id, db, relation):
-       Thread.__init__(self)
-       self.queue = queue
-       self.queries = queries
-       self.seq_id = seq_id
-       self.db = db
-       self.relation = relation
-
-   def executeSearchCommand(self,command):
-       return self.db.executeAndReturn(command)
-
-   def run(self):
-       node_way_query = """ INSERT INTO relations_members VALUES ({0}, {1}, {2}, '{3}', '{4}', {5}) """
-       while True:
-           # Get the work from the queue
-           item = self.queue.get()
-
-           # Now to make sure that the zone is in the database, we want to make
-           # sure that either the node or the way is already in db (as both nodes insertion
-           # and ways insertion make sure that entity is in zone)
-           if item.type.replace("'","") == 'n':
-               #  If item is a node
-               node_query = """SELECT * from nodes where id = {0} limit 1;"""
-               current_node = self.executeSearchCommand(node_query.format(item.ref))
-               if current_node == None:
-                   logAction("Discarding a node from a relation, id: "+str(item.ref))
-                   self.queue.task_done()
-                   continue
-
-           elif (item.type.replace("'","")) == 'w':
-               # if item is a way
-               way_query = """SELECT * from ways where id = {0} limit 1;"""
-               current_way = self.executeSearchCommand(way_query.format(item.ref))
-               if current_way == None:
-                   logAction("Discarding a way from a relation, id: "+str(item.ref))
-                   self.queue.task_done()
-                   continue
-
-           else:
-               # if item is a relation
-               relation_query = """SELECT * from relations where id = {0} limit 1;"""
-               current_relation = self.executeSearchCommand(relation_query.format(item.ref))
-               if current_relation == None:
-                   logAction("Discarding a relation from a relation, id: "+str(item.ref))
-                   self.queue.task_done()
-                   continue
-
-           logAction("Adding an item of type"+ item.type.replace("'","") +" to a relation, id: "+str(item.ref))
-           self.queries.append( node_way_query.format(self.relation.id,self.relation.version,item.ref,item.type.replace("'",""),item.role.replace("'",""),self.seq_id.getValue()) )
-           self.seq_id.increment()
-           self.queue.task_done()
-
-
-# ======= Counter for seq id ==========
-class Counter(object):
-    def __init__(self, start=0):
+    def add(self, table, row):
+        self.rows[table].append(row)
+        self.pending += 1
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        flush_time = time.time()
+        try:
+            for table in TABLES:
+                if len(self.rows[table]) > 0:
+                    self.connection.executemany(self.inserts[table], (sqliteRow(row) for row in self.rows[table]))
+        except sqlite3.Error as error:
+            print('\033[91m'+"\nSQLITE ERROR:\n"+str(error)+'\033[0m')
+            print('Ignoring error, '+str(self.pending)+' rows discarded...')
+            self.connection.rollback()
+        else:
+            self.connection.commit()
+            metrics.count('rows_written', self.pending)
+        metrics.time('db_flush', time.time()-flush_time)
+
+        self.rows = dict((table, []) for table in TABLES)
+        self.pending = 0
+
+    # Everything is written once flushed
+    def sync(self):
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+class CsvWriter(object):
+    """write rows into CSV files to be loaded later with psql.
+
+    Each table gets a directory of files of CSV_PARTITION_ROWS rows at most,
+    and load.sql creates the tables and loads every file with \\copy."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = 0
+        self.checkpoint = None
+        self.buffers = dict((table, io.StringIO()) for table in TABLES)
+        self.files = dict((table, []) for table in TABLES)
+        self.file_rows = dict((table, CSV_PARTITION_ROWS) for table in TABLES)
+        self.columns = {}
+        try:
+            for table in TABLES:
+                os.makedirs(os.path.join(directory, table), exist_ok=True)
+                # Files of a previous run would be loaded along with the new ones
+                for name in os.listdir(os.path.join(directory, table)):
+                    if name.startswith('part-') and name.endswith('.csv'):
+                        os.remove(os.path.join(directory, table, name))
+        except OSError as error:
+            print('\033[91m'+"Unable to create "+directory+": "+str(error)+'\033[0m')
+            sys.exit(-1)
+        for table in TABLES:
+            self.columns[table] = [line.split()[0] for line in TABLE_COLUMNS[table].strip().split(',\n')]
+
+    def add(self, table, row):
+        # Rows of the current file are written before starting a new one
+        if self.file_rows[table] >= CSV_PARTITION_ROWS:
+            self.writeBuffer(table)
+            self.files[table].append(os.path.join(table, "part-%05d.csv" % len(self.files[table])))
+            self.file_rows[table] = 0
+            file = open(os.path.join(self.directory, self.files[table][-1]), "w")
+            file.write(','.join(self.columns[table])+'\n')
+            file.close()
+        self.buffers[table].write(','.join(csvValue(v) for v in row)+'\n')
+        self.file_rows[table] += 1
+        self.pending += 1
+
+    def writeBuffer(self, table):
+        data = self.buffers[table].getvalue()
+        if len(data) == 0:
+            return
+        file = open(os.path.join(self.directory, self.files[table][-1]), "a")
+        file.write(data)
+        file.close()
+        self.buffers[table] = io.StringIO()
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        flush_time = time.time()
+        for table in TABLES:
+            self.writeBuffer(table)
+        metrics.time('db_flush', time.time()-flush_time)
+        metrics.count('rows_written', self.pending)
+        self.pending = 0
+
+    # Everything is written once flushed
+    def sync(self):
+        self.flush()
+
+    # Write the script loading the files, parents first
+    def close(self):
+        self.flush()
+        file = open(os.path.join(self.directory, "load.sql"), "w")
+        file.write("-- Load with: cd "+self.directory+" && psql -d <dbname> -f load.sql\n")
+        file.write("BEGIN;\n")
+        for table in TABLES:
+            file.write(createTableCommand(table)+";\n")
+        for table in TABLES:
+            for name in self.files[table]:
+                file.write("\\copy "+table+" FROM '"+name+"' WITH (FORMAT csv, HEADER true)\n")
+        file.write("COMMIT;\n")
+        file.close()
+
+# Escape characters having a special meaning in COPY text format
+COPY_TEXT_ESCAPES = str.maketrans({'\\':'\\\\', '\t':'\\t', '\n':'\\n', '\r':'\\r'})
+
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+def sqlValue(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (bool, int)):
+        return str(value)
+    if isinstance(value, list):
+        return "'"+arrayLiteral(value)+"'"
+    if isinstance(value, bytes):
+        return "'\\x"+value.hex()+"'"
+    return "'"+str(value).replace("'","''")+"'"
+
+def copyTextValue(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, list):
+        return arrayLiteral(value)
+    if isinstance(value, bytes):
+        value = '\\x'+value.hex()
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+def copyBinaryRow(types, row):
+    data = [struct.pack('>h', len(row))]
+    for type, value in zip(types, row):
+        if value is None:
+            data.append(struct.pack('>i', -1))
+        elif type == 'q':
+            data.append(struct.pack('>iq', 8, value))
+        elif type == 'i':
+            data.append(struct.pack('>ii', 4, value))
+        elif type == 'b':
+            data.append(struct.pack('>i?', 1, value))
+        elif type == 't':
+            data.append(struct.pack('>iq', 8, timestampMicros(value)))
+        elif type == 'a':
+            data.append(intArray(value))
+        elif type == 'y':
+            data.append(struct.pack('>i', len(value)))
+            data.append(value)
+        else:
+            encoded = str(value).encode('utf-8')
+            data.append(struct.pack('>i', len(encoded)))
+            data.append(encoded)
+    return b''.join(data)
+
+def copyData(cur, table, data, binary):
+    if binary:
+        cur.copy_expert("COPY "+table+" FROM STDIN WITH (FORMAT binary)", io.BytesIO(COPY_BINARY_HEADER + data + COPY_BINARY_TRAILER), COPY_READ_SIZE)
+    else:
+        cur.copy_expert("COPY "+table+" FROM STDIN", io.StringIO(data), COPY_READ_SIZE)
+
+# ============= Failing rows ==============
+
+# Run the items (statements or encoded rows) of a batch which failed as a
+# whole with run(cur, items), in the current transaction. A range of items
+# failing is rolled back to its savepoint and split in halves, until the
+# items failing alone are found: they are given to reject(cur, item, error).
+# Return the number of items rejected.
+def isolateFailures(cur, items, run, reject):
+    rejected = 0
+    ranges = [(0, len(items))]
+    while len(ranges) > 0:
+        lo, hi = ranges.pop()
+        cur.execute("SAVEPOINT isolate")
+        try:
+            run(cur, items[lo:hi])
+        except psycopg2.Error as error:
+            cur.execute("ROLLBACK TO SAVEPOINT isolate")
+            if hi - lo == 1:
+                reject(cur, items[lo], error)
+                rejected += 1
+            else:
+                # The first half is run first, to keep the order of the batch
+                middle = (lo + hi) // 2
+                ranges.append((middle, hi))
+                ranges.append((lo, middle))
+        cur.execute("RELEASE SAVEPOINT isolate")
+    return rejected
+
+def executeStatements(cur, statements):
+    cur.execute(";\n".join(statements))
+
+def executeTableStatements(cur, items):
+    executeStatements(cur, [statement for table, statement in items])
+
+def copyItems(cur, rows, table, binary):
+    copyData(cur, table, (b'' if binary else '').join(rows), binary)
+
+# Copy a buffer of encoded rows after the failure of its batch, saving
+# the rows failing in the rejects table. Return their number.
+def copyIsolating(cur, table, name, data, binary):
+    return isolateFailures(cur, copyRows(data, binary), partial(copyItems, table=name, binary=binary),
+        partial(rejectItem, table=table, binary=binary))
+
+# Split a buffer of encoded rows, in the COPY text or binary format
+def copyRows(data, binary):
+    if not binary:
+        # Line breaks inside values are escaped
+        return [line+'\n' for line in data.split('\n')[:-1]]
+    rows = []
+    start = 0
+    while start < len(data):
+        end = start + 2
+        for field in range(struct.unpack_from('>h', data, start)[0]):
+            size = struct.unpack_from('>i', data, end)[0]
+            end += 4 + max(size, 0)
+        rows.append(data[start:end])
+        start = end
+    return rows
+
+# Save a statement, or an encoded row of table, in the rejects table. Binary
+# rows are saved as hexadecimal, in the bytea format.
+def rejectItem(cur, item, error, table=None, binary=False):
+    row_data = '\\x'+item.hex() if binary else item.rstrip('\n')
+    cur.execute("INSERT INTO "+REJECT_TABLE+" VALUES (%s, %s, %s, now())", (table, row_data, str(error).strip()))
+
+# Empty fields are NULL, so empty strings are quoted
+def csvValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, list):
+        return '"'+arrayLiteral(value)+'"'
+    if isinstance(value, bytes):
+        return '\\x'+value.hex()
+    value = str(value)
+    if value == '' or any(c in value for c in CSV_QUOTED):
+        return '"'+value.replace('"','""')+'"'
+    return value
+
+CSV_QUOTED = ',"\n\r\\'
+
+# SQLite has no boolean, timestamp nor array type
+def sqliteRow(row):
+    return tuple(int(v) if isinstance(v, bool) else v.strftime('%Y-%m-%d %H:%M:%S') if isinstance(v, datetime) else
+        arrayLiteral(v) if isinstance(v, list) else v for v in row)
+
+# Integer array in the PostgreSQL text format
+def arrayLiteral(values):
+    return '{'+','.join(map(str, values))+'}'
+
+# Integer array in the PostgreSQL binary format: dimensions, no null,
+# int4 elements, then the length and lower bound of the dimension
+def intArray(values):
+    if len(values) == 0:
+        return struct.pack('>iiii', 12, 0, 0, INT4_OID)
+    data = struct.pack('>iiiiii', 20+8*len(values), 1, 0, INT4_OID, len(values), 1)
+    return data + b''.join(struct.pack('>ii', 4, v) for v in values)
+
+INT4_OID = 23
+
+# Microseconds since 2000-01-01, the PostgreSQL timestamp epoch
+def timestampMicros(ts):
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    delta = ts - PG_EPOCH
+    return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+
+# ============= Metrics ==============
+
+class Metrics(object):
+    """counters and timers of the import, by phase.
+
+    Counters and timers are updated from the main process, once per batch
+    when possible, or from the threads loading the batches."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        # (start, end) of each phase, end is None for the current one
+        self.phase_times = {}
+        self.timers = {}
         self.lock = Lock()
-        self.value = start
+        self.setPhase("Setup")
 
-    def increment(self):
+    def setPhase(self, phase):
+        now = time.time()
+        if len(self.phases) > 0:
+            self.phase_times[self.phase] = (self.phase_times[self.phase][0], now)
+        self.phase = phase
+        self.current = self.phases.setdefault(phase, {})
+        self.phase_times[phase] = (now, None)
+
+    def count(self, name, value=1):
         with self.lock:
-            self.value = self.value + 1
+            self.current[name] = self.current.get(name, 0) + value
+
+    # Count discarded entities, by entity type and by reason
+    def discard(self, type, reason, value=1):
+        self.count(type+'_discarded', value)
+        self.count('discarded.'+reason, value)
 
-    def getValue(self):
+    def time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def total(self, name):
+        return sum(counters.get(name, 0) for counters in list(self.phases.values()))
+
+    def totals(self):
+        totals = {}
+        for counters in list(self.phases.values()):
+            for name, value in list(counters.items()):
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    # Counters of an interrupted import, see Checkpoint
+    def restore(self, counters):
+        self.phases["Resumed"] = dict(counters)
+
+    def snapshot(self):
+        now = time.time()
         with self.lock:
-            return self.value
+            timers = dict((name, {'count': t[0], 'total': round(t[1], 6), 'max': round(t[2], 6)}) for name, t in self.timers.items())
+        phases = {}
+        for phase, counters in list(self.phases.items()):
+            start, end = self.phase_times.get(phase, (now, now))
+            phases[phase] = {'elapsed': round((end or now) - start, 3), 'counters': dict(counters)}
+        return {'time': round(now, 3), 'elapsed': round(now - self.start, 3), 'phase': self.phase,
+            'counters': self.totals(), 'phases': phases, 'timers': timers}
+
+metrics = Metrics()
+
+class MetricsReporter(Thread):
+    """append a snapshot of the metrics to a JSON lines file periodically."""
+
+    def __init__(self, path, interval=METRICS_INTERVAL):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.stopped = Event()
+        self.last = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    # Write a snapshot, with the entities per second since the previous one
+    def report(self):
+        snapshot = metrics.snapshot()
+        entities = sum(snapshot['counters'].get(type+state, 0) for type in ['nodes', 'ways', 'relations'] for state in ['_added', '_discarded'])
+        if self.last != None and snapshot['time'] > self.last[0]:
+            snapshot['entities_per_sec'] = round((entities - self.last[1]) / (snapshot['time'] - self.last[0]), 1)
+        self.last = (snapshot['time'], entities)
+        file = open(self.path, "a")
+        file.write(json.dumps(snapshot)+"\n")
+        file.close()
 
-#  ============ Process starting threads =========
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
 
-def processDealWithWay(way,db,queries):
-    # Prepare for concurrency
-    queue = Queue()
-    sequence_id = Counter()
+# ============= Checkpoints ==============
 
-    tempQueries = []
+# Order of entity types in history files
+ENTITY_RANKS = {'n': 0, 'w': 1, 'r': 2}
 
-    # Start 20 workers
-    for x in range(25):
-        worker = WayNodeChecker(queue,tempQueries,sequence_id,db, way)
-        # Setting daemon to True will let the main thread exit even though the workers are blocking
-        worker.daemon = True
-        worker.start()
+class Checkpoint(object):
+    """last entity whose rows were handed to the writer, saved with each flush."""
 
-    for mynode in way.nodes:
-        logAction("Checking node for way: "+str(mynode.ref))
-        queue.put(mynode)
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.phase = NODE_TYPE
+        self.type = None
+        self.id = None
+        self.version = None
 
-    # Wait for workers to be done with analyzing all items in queue
-    queue.join()
-    queries += tempQueries
+    def set(self, type, id, version):
+        self.type = type
+        self.id = id
+        self.version = version
 
+    # Position in the file, None if nothing was imported yet
+    def position(self):
+        if self.type == None:
+            return None
+        return (ENTITY_RANKS[self.type], self.id, self.version)
+
+    def command(self):
+        counters = json.dumps(metrics.totals())
+        values = ",".join(sqlValue(v) for v in [1, self.file_name, self.phase, self.type, self.id, self.version, counters])
+        return ("INSERT INTO "+CHECKPOINT_TABLE+" VALUES ("+values+", now()) ON CONFLICT (id) DO UPDATE SET "+
+            "file_name = EXCLUDED.file_name, phase = EXCLUDED.phase, entity_type = EXCLUDED.entity_type, "+
+            "entity_id = EXCLUDED.entity_id, entity_version = EXCLUDED.entity_version, "+
+            "counters = EXCLUDED.counters, updated_at = EXCLUDED.updated_at")
+
+    # Read the last checkpoint and restore the counters, return False if there is none
+    def load(self, db):
+        row = db.executeAndReturn("SELECT file_name, phase, entity_type, entity_id, entity_version, counters FROM "+CHECKPOINT_TABLE+" WHERE id = 1")
+        if row == None:
+            return False
+        file_name, self.phase, self.type, self.id, self.version, counters = row
+        if os.path.basename(file_name) != os.path.basename(self.file_name):
+            print('\033[91m'+"\nERROR: the checkpoint was written while importing "+file_name+"."+'\033[0m')
+            sys.exit(-1)
+
+        metrics.restore(counters)
+        return True
 
-def processDealWithRelation(relation,db,queries):
-    # Prepare for concurrency
-    queue = Queue()
-    sequence_id = Counter()
+    # Forget the checkpoint of a previous import
+    def reset(self, db):
+        db.execute(["DELETE FROM "+CHECKPOINT_TABLE])
 
-    tempQueries = []
+# ============= Node versions index ==============
 
-    # Start 20 workers
-    for x in range(25):
-        worker = RelationMemberChecker(queue,tempQueries,sequence_id,db, relation)
-        # Setting daemon to True will let the main thread exit even though the workers are blocking
-        worker.daemon = True
-        worker.start()
+class NodeVersionIndex(object):
+    """versions of the kept nodes in compact arrays, sorted by id then timestamp."""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.timestamps = array('q')
+        self.versions = array('q')
+        self.xs = array('i')
+        self.ys = array('i')
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        if not self.sorted:
+            self.sort()
+        i = bisect_left(self.ids, id)
+        return i < len(self.ids) and self.ids[i] == id
+
+    def add(self, id, version, timestamp, x, y):
+        timestamp = int(timestamp.timestamp())
+        # History files are sorted, so appending usually keeps the order
+        if len(self.ids) > 0 and (id < self.ids[-1] or (id == self.ids[-1] and timestamp < self.timestamps[-1])):
+            self.sorted = False
+        self.ids.append(id)
+        self.timestamps.append(timestamp)
+        self.versions.append(version)
+        self.xs.append(x)
+        self.ys.append(y)
+
+    def sort(self):
+        ids = np.frombuffer(self.ids, dtype=np.int64)
+        # lexsort sorts by the last key first, and is stable
+        order = np.lexsort((np.frombuffer(self.timestamps, dtype=np.int64), ids))
+        self.ids = array('q', ids[order].tobytes())
+        self.timestamps = array('q', np.frombuffer(self.timestamps, dtype=np.int64)[order].tobytes())
+        self.versions = array('q', np.frombuffer(self.versions, dtype=np.int64)[order].tobytes())
+        self.xs = array('i', np.frombuffer(self.xs, dtype=np.int32)[order].tobytes())
+        self.ys = array('i', np.frombuffer(self.ys, dtype=np.int32)[order].tobytes())
+        self.sorted = True
+
+    # Add the kept nodes of a batch, given as NumPy arrays
+    def addMany(self, ids, versions, timestamps, xs, ys):
+        if len(ids) == 0:
+            return
+        if self.sorted:
+            if len(self.ids) > 0 and (ids[0] < self.ids[-1] or (ids[0] == self.ids[-1] and timestamps[0] < self.timestamps[-1])):
+                self.sorted = False
+            id_steps = np.diff(ids)
+            if np.any(id_steps < 0) or np.any((id_steps == 0) & (np.diff(timestamps) < 0)):
+                self.sorted = False
+        self.ids.frombytes(ids.astype(np.int64).tobytes())
+        self.timestamps.frombytes(timestamps.astype(np.int64).tobytes())
+        self.versions.frombytes(versions.astype(np.int64).tobytes())
+        self.xs.frombytes(xs.astype(np.int32).tobytes())
+        self.ys.frombytes(ys.astype(np.int32).tobytes())
+
+    # Return (version, x, y) of the latest node version created at or before
+    # timestamp, or of the first version if all were created after it
+    def lookup(self, id, timestamp):
+        if not self.sorted:
+            self.sort()
+        lo = bisect_left(self.ids, id)
+        hi = bisect_right(self.ids, id, lo)
+        if lo == hi:
+            return None
+        i = bisect_right(self.timestamps, int(timestamp.timestamp()), lo, hi) - 1
+        if i < lo:
+            i = lo
+        return (self.versions[i], self.xs[i], self.ys[i])
 
-    for member in relation.members:
-        logAction("Checking member for relation: "+str(member.ref))
-        queue.put(member)
+# ============= Kept ids ==============
 
-    # Wait for workers to be done with analyzing all items in queue
-    queue.join()
-    queries += tempQueries
+class IdSet(object):
+    """ids of kept entities in a sorted array, 8 bytes per id."""
 
-# ============= Importer class ==============
+    def __init__(self):
+        self.ids = array('q')
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id):
+        if len(self.ids) > 0:
+            # Versions of an entity follow each other in history files
+            if id == self.ids[-1]:
+                return
+            if id < self.ids[-1]:
+                self.sorted = False
+        self.ids.append(id)
+
+    def __contains__(self, id):
+        if not self.sorted:
+            self.ids = array('q', np.unique(np.frombuffer(self.ids, dtype=np.int64)).tobytes())
+            self.sorted = True
+        i = bisect_left(self.ids, id)
+        return i < len(self.ids) and self.ids[i] == id
+
+    # Add ids given as a NumPy array
+    def addMany(self, ids):
+        if len(ids) == 0:
+            return
+        ids = ids[np.r_[True, ids[1:] != ids[:-1]]]
+        if len(self.ids) > 0 and ids[0] == self.ids[-1]:
+            ids = ids[1:]
+        if len(ids) == 0:
+            return
+        if (len(self.ids) > 0 and ids[0] < self.ids[-1]) or np.any(np.diff(ids) < 0):
+            self.sorted = False
+        self.ids.frombytes(ids.astype(np.int64).tobytes())
+
+class KeptIds(object):
+    """entities kept so far, used to check if relation members are in zone."""
+
+    def __init__(self, index):
+        # The node index already holds the ids of kept nodes
+        self.nodes = index
+        self.ways = IdSet()
+        self.relations = IdSet()
+
+    def contains(self, type, id):
+        if type == 'n':
+            return id in self.nodes
+        elif type == 'w':
+            return id in self.ways
+        return id in self.relations
+
+# ============= Dictionary encoding ==============
+
+# Switch the entity tables to the normalized schema: user_id instead of
+# user_name, tag_keys and tag_values arrays of ids instead of the tags json.
+# Dictionary tables are loaded first, they don't depend on any entity.
+def normalizeTables():
+    global NORMALIZE
+    NORMALIZE = True
+    for table in ['nodes', 'ways', 'relations']:
+        TABLE_COLUMNS[table] = TABLE_COLUMNS[table].replace("user_name VARCHAR(255) NOT NULL", "user_id INT NOT NULL").replace(
+            "tags json NOT NULL", "tag_keys INT[] NOT NULL,\n            tag_values INT[] NOT NULL")
+        types = COPY_TYPES[table]
+        COPY_TYPES[table] = types[:7]+'i'+types[8:-1]+'aa'
+    TABLES[0:0] = DICTIONARY_TABLES
+    for table in DICTIONARY_TABLES:
+        TABLE_RANKS[table] = -1
+
+# Entity rows are normalized by the dictionary, user name being
+# their 8th value and tags (as (key, value) pairs) their last one
+NORMALIZED_TABLES = {'nodes', 'ways', 'relations'}
+
+class Dictionary(object):
+    """user names, tag keys and tag values interned as integer ids.
+
+    New entries are written to their table just before the first row
+    referencing them."""
 
-class Importer(object):
+    def __init__(self):
+        self.ids = dict((table, {}) for table in DICTIONARY_TABLES)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.ids.values())
+
+    def lookup(self, table, value, writer):
+        ids = self.ids[table]
+        id = ids.get(value)
+        if id == None:
+            id = len(ids)+1
+            ids[value] = id
+            writer.add(table, (id, value))
+        return id
+
+    # Replace the user name and the tags of an entity row by ids
+    def encode(self, row, writer):
+        keys = self.ids['tag_keys']
+        values = self.ids['tag_values']
+        key_ids = []
+        value_ids = []
+        for k, v in row[-1]:
+            id = keys.get(k)
+            key_ids.append(id if id != None else self.lookup('tag_keys', k, writer))
+            id = values.get(v)
+            value_ids.append(id if id != None else self.lookup('tag_values', v, writer))
+        return row[:7] + (self.lookup('users', row[7], writer),) + row[8:-1] + (key_ids, value_ids)
+
+    # Read back the entries of an interrupted import
+    def load(self, db):
+        for table in DICTIONARY_TABLES:
+            cur = db.connection.cursor('resume_'+table)
+            cur.itersize = NODE_BATCH_SIZE
+            cur.execute("SELECT * FROM "+db.tables[table])
+            for id, value in cur:
+                self.ids[table][value] = id
+            cur.close()
+        db.connection.commit()
 
-    def __init__(self,datatype, db):
-        self.db = db
-        self.datatype=datatype
-        self.insertion_commands=[]
+class LatestVersions(object):
+    """latest imported version of each entity of a table."""
 
-    # Deal with one entity (node, way or relation)
-    def add(self, o):
+    def __init__(self):
+        self.ids = array('q')
+        self.versions = array('q')
+
+    def load(self, db, table, ids_table=None):
+        cur = db.connection.cursor('latest_'+table)
+        cur.itersize = NODE_BATCH_SIZE
+        cur.execute("SELECT id, max(version) FROM "+table+joinIds(ids_table)+" GROUP BY id ORDER BY id")
+        for id, version in cur:
+            self.ids.append(id)
+            self.versions.append(version)
+        cur.close()
+        db.connection.commit()
+
+    def contains(self, id, version):
+        i = bisect_left(self.ids, id)
+        return i < len(self.ids) and self.ids[i] == id and version <= self.versions[i]
+
+class ChangeIds(o.SimpleHandler):
+    """ids of the entities of change files, and of the entities they refer
+    to: only these are read back from the tables before applying them."""
 
-        # We jsonify tags
-        o.jsontags = self.jsonifyTags(o.tags)
+    def __init__(self):
+        super(ChangeIds, self).__init__()
+        self.ids = {'n': array('q'), 'w': array('q'), 'r': array('q')}
 
-        if self.datatype==NODE_TYPE:
-            query = self.insertNodeSQL(o)
-            if query!= None:
-                self.insertion_commands.append(query)
-        elif self.datatype==WAY_TYPE:
-            query = self.insertWaySQL(o)
-            if query!= None:
-                self.insertion_commands += query
-        elif self.datatype==RELATION_TYPE:
-            query = self.insertRelationSQL(o)
-            if query != None:
-                self.insertion_commands += query
+    def node(self, n):
+        self.ids['n'].append(n.id)
+
+    def way(self, w):
+        self.ids['w'].append(w.id)
+        self.ids['n'].extend(node.ref for node in w.nodes)
+
+    def relation(self, r):
+        self.ids['r'].append(r.id)
+        for member in r.members:
+            self.ids[member.type].append(member.ref)
+
+    # Sorted ids of each table
+    def tables(self):
+        return [(table, np.unique(np.frombuffer(self.ids[type], dtype=np.int64))) for type, table in [('n', 'nodes'), ('w', 'ways'), ('r', 'relations')]]
+
+# Copy ids into a temporary table of the connection, joined to read back
+# the rows of these entities only
+def loadIdsTable(db, name, ids):
+    cur = db.connection.cursor()
+    cur.execute("DROP TABLE IF EXISTS "+name+"; CREATE TEMPORARY TABLE "+name+" (id BIGINT PRIMARY KEY)")
+    cur.copy_expert("COPY "+name+" FROM STDIN", io.StringIO(''.join(str(id)+'\n' for id in ids.tolist())), COPY_READ_SIZE)
+    cur.execute("ANALYZE "+name)
+    cur.close()
+    db.connection.commit()
+
+# Join restricting a query to the ids of a temporary table, if any
+def joinIds(ids_table):
+    if ids_table == None:
+        return ""
+    return " JOIN "+ids_table+" USING (id)"
+
+# ============= Polygon zones ==============
+
+CELL_OUTSIDE = 0
+CELL_INSIDE = 1
+CELL_BOUNDARY = 2
+
+class PolygonZone(object):
+    """zone made of polygons, with a grid index over their bounding box.
+
+    Cells crossed by an edge are boundary cells, the others are entirely
+    inside or outside. Only points in boundary cells are tested exactly,
+    by ray casting against the edges crossing their horizontal strip (rows
+    of cells are cut in strips so that few edges cross each one).
+    Coordinates are the ones of pyosmium locations (x is the longitude)."""
+
+    def __init__(self, rings, size=POLYGON_GRID_SIZE):
+        edges = []
+        for ring in rings:
+            ring = np.asarray(ring, dtype=np.float64)
+            # Rings are closed, the last point may repeat the first one or not
+            if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+                ring = ring[:-1]
+            if len(ring) < 3:
+                continue
+            edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+        if len(edges) == 0:
+            print('\033[91m'+"The polygon zone has no ring of at least 3 points."+'\033[0m')
+            sys.exit(-1)
+        edges = np.vstack(edges)
+        self.x1, self.y1, self.x2, self.y2 = edges.T
+        points = np.vstack([edges[:, 0:2], edges[:, 2:4]])
+        self.min_x, self.min_y = points.min(axis=0)
+        self.max_x, self.max_y = points.max(axis=0)
+        self.size = size
+        self.cell_width = max((self.max_x - self.min_x) / size, 1.0)
+        self.cell_height = max((self.max_y - self.min_y) / size, 1.0)
+
+        # Edges crossing each strip, for the exact tests: the edges of
+        # strip i are the items strip_offsets[i] to strip_offsets[i+1] of
+        # the strip_ arrays (horizontal edges are never crossed by a ray)
+        self.strips = size * POLYGON_STRIPS_PER_ROW
+        sloped = np.flatnonzero(self.y1 != self.y2)
+        low = self.strip(np.minimum(self.y1, self.y2)[sloped])
+        high = self.strip(np.maximum(self.y1, self.y2)[sloped])
+        strips = np.concatenate([np.arange(low[i], high[i]+1) for i in range(len(sloped))])
+        edge_ids = np.repeat(sloped, high - low + 1)
+        order = np.argsort(strips, kind='stable')
+        edge_ids = edge_ids[order]
+        self.strip_offsets = np.searchsorted(strips[order], np.arange(self.strips+1))
+        self.strip_x1 = self.x1[edge_ids]
+        self.strip_y1 = self.y1[edge_ids]
+        self.strip_y2 = self.y2[edge_ids]
+        self.strip_slopes = (self.x2[edge_ids] - self.x1[edge_ids]) / (self.y2[edge_ids] - self.y1[edge_ids])
+
+        self.cells = np.zeros((size, size), dtype=np.int8)
+        for edge in range(len(edges)):
+            self.markEdge(self.x1[edge], self.y1[edge], self.x2[edge], self.y2[edge])
+
+        # Other cells are entirely on the side of their center: a center is
+        # inside if an odd number of edges cross its line on its right
+        centers = self.min_x + (np.arange(size) + 0.5) * self.cell_width
+        for row in range(size):
+            y = self.min_y + (row + 0.5) * self.cell_height
+            strip = self.strip(np.array([y]))[0]
+            edges = slice(self.strip_offsets[strip], self.strip_offsets[strip+1])
+            x1, y1, y2, slopes = self.strip_x1[edges], self.strip_y1[edges], self.strip_y2[edges], self.strip_slopes[edges]
+            crossing = (y1 > y) != (y2 > y)
+            xs_at = np.sort(x1[crossing] + (y - y1[crossing]) * slopes[crossing])
+            right = len(xs_at) - np.searchsorted(xs_at, centers, side='right')
+            states = np.where(right % 2 == 1, CELL_INSIDE, CELL_OUTSIDE)
+            self.cells[row] = np.where(self.cells[row] == CELL_BOUNDARY, CELL_BOUNDARY, states)
+
+    def column(self, xs):
+        return np.clip(((xs - self.min_x) / self.cell_width).astype(np.int64), 0, self.size-1)
+
+    def row(self, ys):
+        return np.clip(((ys - self.min_y) / self.cell_height).astype(np.int64), 0, self.size-1)
+
+    def strip(self, ys):
+        return np.clip(((ys - self.min_y) * (POLYGON_STRIPS_PER_ROW / self.cell_height)).astype(np.int64), 0, self.strips-1)
+
+    # Mark the cells crossed by an edge, column by column
+    def markEdge(self, x1, y1, x2, y2):
+        first, last = self.column(np.array([min(x1, x2), max(x1, x2)]))
+        for column in range(first, last+1):
+            if x1 == x2:
+                ys = [y1, y2]
+            else:
+                # Part of the edge in the column
+                left = max(min(x1, x2), self.min_x + column * self.cell_width)
+                right = min(max(x1, x2), self.min_x + (column+1) * self.cell_width)
+                ys = [y1 + (x - x1) * (y2 - y1) / (x2 - x1) for x in (left, right)]
+            low, high = self.row(np.array([min(ys), max(ys)]))
+            self.cells[low:high+1, column] = CELL_BOUNDARY
+
+    # Even-odd rule: count the edges crossed by a ray going right from each
+    # point, among the edges of its strip. (point, edge) pairs are tested at
+    # once, by chunks of points.
+    def rayCast(self, xs, ys):
+        inside = np.zeros(len(xs), dtype=bool)
+        if len(xs) == 0:
+            return inside
+        strips = self.strip(ys)
+        counts = self.strip_offsets[strips+1] - self.strip_offsets[strips]
+        step = max(1, RAY_CAST_PAIRS // max(1, int(counts.max())))
+        for start in range(0, len(xs), step):
+            end = start + step
+            inside[start:end] = self.rayCastChunk(strips[start:end], xs[start:end], ys[start:end], counts[start:end])
+        return inside
+
+    def rayCastChunk(self, strips, xs, ys, counts):
+        points = np.repeat(np.arange(len(xs)), counts)
+        pairs = np.arange(len(points)) - np.repeat(np.cumsum(counts) - counts, counts)
+        edges = np.repeat(self.strip_offsets[strips], counts) + pairs
+        y1 = self.strip_y1[edges]
+        ys = ys[points]
+        crossing = (y1 > ys) != (self.strip_y2[edges] > ys)
+        xs_at = self.strip_x1[edges] + (ys - y1) * self.strip_slopes[edges]
+        crossed = crossing & (xs[points] < xs_at)
+        return (np.bincount(points[crossed], minlength=len(xs)) % 2) == 1
+
+    # Return a mask of the points inside the zone
+    def contains(self, xs, ys):
+        xs = xs.astype(np.float64)
+        ys = ys.astype(np.float64)
+        inside = np.zeros(len(xs), dtype=bool)
+        candidates = np.flatnonzero((xs >= self.min_x) & (xs <= self.max_x) & (ys >= self.min_y) & (ys <= self.max_y))
+        if len(candidates) == 0:
+            return inside
+        rows = self.row(ys[candidates])
+        states = self.cells[rows, self.column(xs[candidates])]
+        inside[candidates[states == CELL_INSIDE]] = True
+
+        boundary = states == CELL_BOUNDARY
+        candidates = candidates[boundary]
+        inside[candidates] = self.rayCast(xs[candidates], ys[candidates])
+        return inside
+
+# Read the polygons of a GeoJSON file (geometry, feature or feature
+# collection), in degrees, as a PolygonZone
+def readPolygonZone(path):
+    try:
+        file = open(path)
+        geojson = json.load(file)
+        file.close()
+    except (OSError, ValueError) as error:
+        print('\033[91m'+"Unable to read the polygon zone "+path+": "+str(error)+'\033[0m')
+        sys.exit(-1)
+
+    rings = []
+    geometries = [geojson]
+    while len(geometries) > 0:
+        geometry = geometries.pop()
+        type = geometry.get('type') if isinstance(geometry, dict) else None
+        if type == 'FeatureCollection':
+            geometries.extend(geometry['features'])
+        elif type == 'Feature':
+            if geometry.get('geometry') != None:
+                geometries.append(geometry['geometry'])
+        elif type == 'GeometryCollection':
+            geometries.extend(geometry['geometries'])
+        elif type == 'Polygon':
+            rings.extend(geometry['coordinates'])
+        elif type == 'MultiPolygon':
+            for polygon in geometry['coordinates']:
+                rings.extend(polygon)
         else:
-            print('\033[91m'+"\nERROR: type"+str( self.datatype)+" not found, or not handled."+'\033[0m')
+            print('\033[91m'+"Unsupported geometry in "+path+": "+str(type)+", use polygons or multipolygons."+'\033[0m')
             sys.exit(-1)
 
-        # Execute commands every 100000
-        if (len(self.insertion_commands)>100000):
-            self.executeCommands()
+    # Same units as the boundaries, 10^-7 degrees
+    return PolygonZone([[(round(lon * 10000000), round(lat * 10000000)) for lon, lat, *rest in ring] for ring in rings])
 
-    def executeCommands(self):
-        self.db.execute( self.insertion_commands )
-        self.insertion_commands = []
+# ============= Node batches ==============
 
-    def executeSearchCommand(self,command):
-        return self.db.executeAndReturn(command)
+class NodeBatch(object):
+    """nodes waiting to be filtered against the zone.
 
-    def jsonifyTags(self,tags):
-        jsontags={}
-        for tag in tags:
-            jsontags[tag.k.replace("'","")] = tag.v.replace("'","")
+    Numeric fields are appended to arrays (cheaper than setting items of
+    NumPy arrays one by one) and filtered at once as NumPy arrays."""
 
-        return json.dumps(jsontags)
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def clear(self):
+        self.ids = array('q')
+        self.versions = array('q')
+        self.timestamps = array('q')
+        self.xs = array('i')
+        self.ys = array('i')
+        # Fields only needed for the kept nodes
+        self.others = []
+        # Versions dropped because they were created after the time window
+        self.late = 0
 
-    # Return a SQL command to insert a node
-    def insertNodeSQL(self,o):
+    def add(self, o):
+        location = o.location
+        timestamp = o.timestamp
+        seconds = int(timestamp.timestamp())
+        if UNTIL != None and seconds >= UNTIL:
+            self.late += 1
+            return
+        self.ids.append(o.id)
+        self.versions.append(o.version)
+        self.timestamps.append(seconds)
+        self.xs.append(location.x)
+        self.ys.append(location.y)
+        # Versions before the time window are only needed by the node index
+        if SINCE != None and seconds < SINCE:
+            self.others.append(None)
+            return
+        self.others.append((o.deleted,o.visible,o.changeset,o.uid,timestamp,o.user,copyTags(o.tags)))
+
+    def arrays(self):
+        return (np.frombuffer(self.ids, dtype=np.int64), np.frombuffer(self.versions, dtype=np.int64),
+            np.frombuffer(self.timestamps, dtype=np.int64), np.frombuffer(self.xs, dtype=np.int32),
+            np.frombuffer(self.ys, dtype=np.int32))
+
+# Return the positions of the points inside the zone, given as
+# (bottom left, top right) or as a PolygonZone, or inside the zone
+# of the command line
+def inZone(xs, ys, zone=None):
+    if zone == None:
+        zone = ZONE_POLYGON if ZONE_POLYGON != None else (BOTTOM_LEFT_BOUNDARY, TOP_RIGHT_BOUNDARY)
+    if isinstance(zone, PolygonZone):
+        return np.flatnonzero(zone.contains(xs, ys))
+    bottom_left, top_right = zone
+    mask = ((xs >= bottom_left[1]) & (xs <= top_right[1]) &
+        (ys >= bottom_left[0]) & (ys <= top_right[0]))
+    return np.flatnonzero(mask)
+
+# Filter a batch against the zone and the time window. Return the number of
+# nodes, the number of them out of the time window, the kept nodes as arrays
+# for the index, their rows and the last node of the batch (None for both
+# when all the nodes were created after the window).
+def filterNodeBatch(batch, zone=None):
+    if len(batch) == 0:
+        return (batch.late, batch.late, None, [], None)
+    ids, versions, timestamps, xs, ys = batch.arrays()
+    kept = inZone(xs, ys, zone)
+    written = kept
+    out_of_window = batch.late
+
+    if SINCE != None:
+        # Versions before the window are not written, but the last one of
+        # each node is indexed: ways of the window may still refer to it
+        before = timestamps[kept] < SINCE
+        kept_ids = ids[kept]
+        last_before = before & np.r_[(kept_ids[1:] != kept_ids[:-1]) | ~before[1:], True]
+        written = kept[~before]
+        kept = kept[~before | last_before]
+        out_of_window += int(np.count_nonzero(timestamps < SINCE))
+
+    rows = []
+    for i in written.tolist():
+        deleted, visible, changeset, uid, timestamp, user, tags = batch.others[i]
+        rows.append((batch.ids[i],deleted,visible,batch.versions[i],changeset,uid,timestamp,user,batch.xs[i],batch.ys[i],tagsValue(tags)))
+
+    return (len(ids) + batch.late, out_of_window, (ids[kept], versions[kept], timestamps[kept], xs[kept], ys[kept]), rows, (batch.ids[-1], batch.versions[-1]))
+
+# Return whether a version created at timestamp is in the time window
+def inWindow(timestamp):
+    if SINCE == None and UNTIL == None:
+        return True
+    seconds = int(timestamp.timestamp())
+    return (SINCE == None or seconds >= SINCE) and (UNTIL == None or seconds < UNTIL)
+
+def beforeWindow(timestamp):
+    return SINCE != None and int(timestamp.timestamp()) < SINCE
+
+# ============= Worker pool ==============
+
+# Ways and relations are copied out of pyosmium objects to be sent to workers
+WayRecord = namedtuple('WayRecord', 'id deleted visible version changeset uid timestamp user tags nodes')
+RelationRecord = namedtuple('RelationRecord', 'id deleted visible version changeset uid timestamp user tags members')
+
+# Set before the pool is started, workers inherit it when forked
+worker_index = None
+
+# Return (id, version, rows) of each way, rows being None for discarded ways
+def dealWithWays(ways):
+    return [(way.id, way.version, wayRows(way, worker_index)) for way in ways]
+
+# Return the rows to insert a way and its nodes, or None if no node is in zone
+def wayRows(way, index):
+    rows = [('ways', (way.id,way.deleted,way.visible,way.version,way.changeset,way.uid,way.timestamp,way.user,tagsValue(way.tags)))]
+
+    sequence_id = 0
+    for ref in way.nodes:
+        current_node = index.lookup(ref,way.timestamp)
+        # filter out nodes which are not in the zone
+        if current_node == None:
+            continue
+        rows.append( ('ways_nodes', (way.id,way.version,ref,current_node[0],sequence_id,current_node[1],current_node[2])) )
+        sequence_id += 1
+
+    if sequence_id == 0:
+        return None
+    addGeometry(rows)
+    return rows
+
+# Add the geometry of a way to its rows (the way, then its nodes) in
+# geometries mode, built from the coordinates of the resolved nodes. Ways
+# with a single node in zone have no geometry.
+def addGeometry(rows):
+    if not GEOMETRIES or len(rows) < 3:
+        return
+    coordinates = []
+    for table, row in rows[1:]:
+        coordinates.append(row[5] / 1e7)
+        coordinates.append(row[6] / 1e7)
+    way = rows[0][1]
+    rows.append( ('ways_geometries', (way[0], way[3], lineStringWkb(coordinates))) )
+
+# WKB (little endian) of a line string, given as x1, y1, x2, y2...
+def lineStringWkb(coordinates):
+    return struct.pack('<BII%dd' % len(coordinates), 1, 2, len(coordinates) // 2, *coordinates)
+
+# Store the geometries of ways, loaded after the ways
+def geometriesTable():
+    global GEOMETRIES
+    GEOMETRIES = True
+    TABLES.insert(TABLES.index('ways')+1, 'ways_geometries')
+    TABLE_RANKS['ways_geometries'] = 1
+
+# Copy tags out of a pyosmium object. Iterating over an empty tag list
+# is surprisingly slow, and most nodes have no tags.
+def copyTags(tags):
+    if len(tags) == 0:
+        return []
+    return [(tag.k, tag.v) for tag in tags]
+
+def wayRecord(o):
+    return WayRecord(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user,
+        copyTags(o.tags),[node.ref for node in o.nodes])
+
+def relationRecord(o):
+    return RelationRecord(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user,
+        copyTags(o.tags),[(member.type, member.ref, member.role) for member in o.members])
+
+# Tags of a row, kept as (key, value) pairs to be encoded by the dictionary
+# when normalizing
+def tagsValue(tags):
+    if NORMALIZE:
+        return tags
+    return jsonifyTags(tags)
+
+def jsonifyTags(tags):
+    jsontags={}
+    for k, v in tags:
+        jsontags[k] = v
+
+    return json.dumps(jsontags)
+
+# ============= Sort-merge resolution ==============
+
+class ExternalSorter(object):
+    """sort records of integers which may not fit in memory.
+
+    Records are sorted by runs of SORT_RUN_SIZE, each run is spilled to a
+    temporary file, and runs are merged when reading the records back."""
+
+    def __init__(self, width):
+        self.width = width
+        self.buffer = array('q')
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, record):
+        self.buffer.extend(record)
+        self.count += 1
+        if len(self.buffer) >= SORT_RUN_SIZE*self.width:
+            self.runs.append(self.spill(self.sortedBuffer()))
+
+    def sortedBuffer(self):
+        records = np.frombuffer(self.buffer, dtype=np.int64).reshape(-1, self.width)
+        # lexsort sorts by the last key first
+        records = records[np.lexsort(records.T[::-1])]
+        self.buffer = array('q')
+        return records
+
+    def spill(self, records):
+        file = tempfile.TemporaryFile(dir=SPILL_DIR)
+        file.write(records.tobytes())
+        file.seek(0)
+        return file
+
+    def readRun(self, file):
+        while True:
+            data = file.read(65536*self.width*8)
+            if len(data) == 0:
+                break
+            for record in np.frombuffer(data, dtype=np.int64).reshape(-1, self.width).tolist():
+                yield tuple(record)
+        file.close()
 
-        global nodes_added, nodes_discarded
+    # Iterate over the records in order, the sorter is emptied
+    def records(self):
+        last = [tuple(record) for record in self.sortedBuffer().tolist()]
+        runs = [self.readRun(file) for file in self.runs]
+        self.runs = []
+        self.count = 0
+        if len(runs) == 0:
+            return iter(last)
+        return heapq.merge(*(runs + [iter(last)]))
+
+class SortMergeResolver(object):
+    """resolve the node versions of ways with sorts and merges instead of
+    the in-memory node index.
+
+    References (node, way timestamp, way, way version, position) are sorted
+    by node and time, and merged with the kept nodes read from the database
+    ordered the same way. The resolved references are sorted back by way
+    and merged with the ways, which are kept meanwhile in a spill file."""
 
-        if self.datatype!=NODE_TYPE:
-            return None
+    def __init__(self, db):
+        self.db = db
+        self.refs = ExternalSorter(5)
+        self.ways = None
+        # Temporary table of the node ids to read back, all when None
+        # (see FileHandler.startChanges)
+        self.ids_table = None
+
+    def __len__(self):
+        return len(self.refs)
+
+    def addWay(self, way):
+        if self.ways == None:
+            self.ways = tempfile.TemporaryFile(dir=SPILL_DIR)
+        timestamp = int(way.timestamp.timestamp())
+        for position, ref in enumerate(way.nodes):
+            self.refs.add((ref, timestamp, way.id, way.version, position))
+        pickle.dump(way._replace(nodes=None), self.ways, pickle.HIGHEST_PROTOCOL)
+
+    # Kept node versions (id, timestamp, version, x, y), ordered by id and time
+    def nodeVersions(self):
+        cur = self.db.connection.cursor('sortmerge_nodes')
+        cur.itersize = NODE_BATCH_SIZE
+        cur.execute("SELECT id, extract(epoch from created_at)::bigint, version, latitude, longitude FROM "+self.db.tables['nodes']+joinIds(self.ids_table)+" ORDER BY id, created_at, version")
+        try:
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+            self.db.connection.commit()
+
+    # Merge the references sorted by node with the node versions, the latest
+    # version created at or before the way is used, or the first one
+    def resolvedRefs(self):
+        resolved = ExternalSorter(7)
+        nodes = self.nodeVersions()
+        node = next(nodes, None)
+        for id, refs in groupby(self.refs.records(), key=lambda ref: ref[0]):
+            while node != None and node[0] < id:
+                node = next(nodes, None)
+            versions = []
+            while node != None and node[0] == id:
+                versions.append(node)
+                node = next(nodes, None)
+            if len(versions) == 0:
+                continue
+            timestamps = [version[1] for version in versions]
+            for ref, timestamp, way, way_version, position in refs:
+                i = max(bisect_right(timestamps, timestamp) - 1, 0)
+                resolved.add((way, way_version, position, ref, versions[i][2], versions[i][3], versions[i][4]))
+        nodes.close()
+        return resolved.records()
+
+    # Return (id, version, rows) of each way in file order, rows being None
+    # for discarded ways
+    def resolve(self):
+        if self.ways == None:
+            return
+        refs = self.resolvedRefs()
+        ref = next(refs, None)
+        self.ways.seek(0)
+        while True:
+            try:
+                way = pickle.load(self.ways)
+            except EOFError:
+                break
+            rows = [('ways', (way.id,way.deleted,way.visible,way.version,way.changeset,way.uid,way.timestamp,way.user,tagsValue(way.tags)))]
+            while ref != None and (ref[0], ref[1]) < (way.id, way.version):
+                ref = next(refs, None)
+            sequence_id = 0
+            while ref != None and ref[0] == way.id and ref[1] == way.version:
+                rows.append( ('ways_nodes', (way.id,way.version,ref[3],ref[4],sequence_id,ref[5],ref[6])) )
+                sequence_id += 1
+                ref = next(refs, None)
+            if sequence_id == 0:
+                yield (way.id, way.version, None)
+                continue
+            addGeometry(rows)
+            yield (way.id, way.version, rows)
+        self.ways.close()
+        self.ways = None
+
+# ============= External sort ==============
+
+class EntitySorter(object):
+    """sort the entities of history files which may not fit in memory.
+
+    Entities are pickled and kept with their (type, id, version) key until
+    SORT_MEMORY bytes are held, then sorted and spilled to a temporary file
+    as a run. Runs are merged when writing the sorted file."""
 
-        # Discard nodes not in zone
-        if (not checkBoundary(o.location.x,o.location.y)):
-            nodes_discarded+=1
-            logAction("Discarding node: "+str(o.location.x)+" "+str(o.location.y))
-            return None
-        query =  """INSERT INTO nodes VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}',
-        {8},{9},'{10}');"""
+    def __init__(self):
+        self.buffer = []
+        self.size = 0
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key, entity):
+        data = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+        self.buffer.append((key, data))
+        # Rough size of the key, the tuple and the bytes object
+        self.size += len(data) + 160
+        self.count += 1
+        if self.size >= SORT_MEMORY:
+            self.runs.append(self.spill())
+
+    def spill(self):
+        self.buffer.sort(key=lambda record: record[0])
+        file = tempfile.TemporaryFile(dir=SPILL_DIR)
+        for record in self.buffer:
+            pickle.dump(record, file, pickle.HIGHEST_PROTOCOL)
+        file.seek(0)
+        self.buffer = []
+        self.size = 0
+        return file
+
+    def readRun(self, file):
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                break
+        file.close()
 
-        logAction("Adding a node")
-        nodes_added +=1
-        return query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""),o.location.x, o.location.y, o.jsontags)
+    # Iterate over the (key, entity) pairs in order, the sorter is emptied.
+    # Entities appearing several times (merged files) are only returned once.
+    def records(self):
+        self.buffer.sort(key=lambda record: record[0])
+        runs = [self.readRun(file) for file in self.runs] + [iter(self.buffer)]
+        self.runs = []
+        self.buffer = []
+        self.size = 0
+        self.count = 0
+        merged = heapq.merge(*runs, key=lambda record: record[0]) if len(runs) > 1 else runs[0]
+        for key, records in groupby(merged, key=lambda record: record[0]):
+            yield key, pickle.loads(next(records)[1])
+            metrics.count('duplicates_dropped', sum(1 for record in records))
+
+class SortHandler(o.SimpleHandler):
+    """copy the entities of a file to an EntitySorter, as the keyword
+    arguments of the mutable pyosmium objects."""
+
+    def __init__(self, sorter):
+        super(SortHandler, self).__init__()
+        self.sorter = sorter
+        # Last key read, to tell if the file is already in order
+        self.last = None
+        self.unordered = 0
+
+    def add(self, key, entity):
+        if self.last != None and key <= self.last:
+            self.unordered += 1
+        self.last = key
+        self.sorter.add(key, entity)
 
-    # Return am array of SQL commands to insert a way
-    def insertWaySQL(self,o):
+    def node(self, n):
+        location = (n.location.lon, n.location.lat) if n.location.valid() else None
+        self.add((0, n.id, n.version), (0, dict(id=n.id, version=n.version, visible=n.visible, changeset=n.changeset,
+            uid=n.uid, timestamp=n.timestamp, user=n.user, tags=copyTags(n.tags), location=location)))
 
-        global ways_added, ways_discarded
+    def way(self, w):
+        self.add((1, w.id, w.version), (1, dict(id=w.id, version=w.version, visible=w.visible, changeset=w.changeset,
+            uid=w.uid, timestamp=w.timestamp, user=w.user, tags=copyTags(w.tags), nodes=[node.ref for node in w.nodes])))
+
+    def relation(self, r):
+        self.add((2, r.id, r.version), (2, dict(id=r.id, version=r.version, visible=r.visible, changeset=r.changeset,
+            uid=r.uid, timestamp=r.timestamp, user=r.user, tags=copyTags(r.tags),
+            members=[(member.type, member.ref, member.role) for member in r.members])))
+
+def removeFile(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+# Sort the entities of the files by type, id and version into a temporary
+# history file, which is returned. It is removed when the script exits.
+def sortFiles(paths):
+    sorter = EntitySorter()
+    handler = SortHandler(sorter)
+    for path in paths:
+        # Files of a merge are each checked for their order
+        handler.last = None
+        handler.apply_file(path)
+    logStep(str(len(sorter))+" entities read, "+str(handler.unordered)+" out of order, "+str(len(sorter.runs))+" runs spilled")
+    descriptor, sorted_path = tempfile.mkstemp(suffix='.osh.pbf', dir=SPILL_DIR)
+    os.close(descriptor)
+    # Removed however the import ends, it can be as large as the input
+    atexit.register(removeFile, sorted_path)
+    header = o.io.Header()
+    header.has_multiple_object_versions = True
+    writer = o.SimpleWriter(sorted_path, header=header, overwrite=True)
+    add = [writer.add_node, writer.add_way, writer.add_relation]
+    types = [o.osm.mutable.Node, o.osm.mutable.Way, o.osm.mutable.Relation]
+    for key, (rank, entity) in sorter.records():
+        add[rank](types[rank](**entity))
+    writer.close()
+    return sorted_path
+
+# ============= Parallel reading ==============
+
+# Largest BlobHeader allowed by the PBF format
+MAX_BLOB_HEADER_SIZE = 64*1024
+
+# Read a protobuf varint, return its value and the position after it.
+# Varints have at most 10 bytes, IndexError is raised at the end of data.
+def readVarint(data, pos):
+    value = 0
+    for shift in range(0, 70, 7):
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+    raise ValueError("varint too long")
+
+# Scan the blobs of a PBF file without decoding them. Each blob is a 4 bytes
+# length, a BlobHeader message (type and size of the blob) and the blob.
+# Return the OSMHeader blob and the (offset, size) of each OSMData blob.
+def pbfBlocks(path):
+    try:
+        return scanBlobs(path)
+    except (IndexError, ValueError, struct.error, UnicodeDecodeError):
+        pass
+    print('\033[91m'+"\nERROR: "+path+" is not a PBF file."+'\033[0m')
+    sys.exit(-1)
+
+# Raise ValueError if the file does not start with an OSMHeader blob or a
+# blob is malformed or truncated
+def scanBlobs(path):
+    header = None
+    blocks = []
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        offset = 0
+        while True:
+            length = file.read(4)
+            if len(length) == 0:
+                break
+            length = struct.unpack('>I', length)[0]
+            if length > MAX_BLOB_HEADER_SIZE:
+                raise ValueError("BlobHeader too large")
+            blob_header = file.read(length)
+            if len(blob_header) < length:
+                raise ValueError("truncated BlobHeader")
+            type = None
+            datasize = 0
+            pos = 0
+            while pos < len(blob_header):
+                key, pos = readVarint(blob_header, pos)
+                if key & 7 == 2:
+                    size, pos = readVarint(blob_header, pos)
+                    if key >> 3 == 1:
+                        type = blob_header[pos:pos+size].decode('ascii')
+                    pos += size
+                elif key & 7 == 0:
+                    value, pos = readVarint(blob_header, pos)
+                    if key >> 3 == 3:
+                        datasize = value
+                else:
+                    raise ValueError("unexpected field in BlobHeader")
+            if pos > len(blob_header):
+                raise ValueError("truncated BlobHeader")
+            if offset == 0 and type != 'OSMHeader':
+                raise ValueError("no OSMHeader blob")
+
+            size = 4 + len(blob_header) + datasize
+            if offset + size > file_size:
+                raise ValueError("truncated blob")
+            if type == 'OSMHeader':
+                file.seek(offset)
+                header = file.read(size)
+            elif type == 'OSMData':
+                blocks.append((offset, size))
+            offset += size
+            file.seek(offset)
+
+    if header == None:
+        raise ValueError("no OSMHeader blob")
+    return header, blocks
+
+class BlockReader(o.SimpleHandler):
+    """decode entities of one type from a range of blocks, in a worker."""
+
+    def __init__(self, rank, resume_from):
+        super(BlockReader, self).__init__()
+        self.rank = rank
+        self.resume_from = resume_from
+
+    def skip(self, o):
+        return self.resume_from != None and (self.rank, o.id, o.version) <= self.resume_from
+
+class NodeBlockReader(BlockReader):
+
+    def __init__(self, resume_from):
+        super(NodeBlockReader, self).__init__(0, resume_from)
+        self.batch = NodeBatch()
+
+    def node(self, n):
+        if not self.skip(n):
+            self.batch.add(n)
 
-        if self.datatype!=WAY_TYPE:
+    def result(self):
+        return filterNodeBatch(self.batch)
+
+class WayBlockReader(BlockReader):
+
+    def __init__(self, resume_from):
+        super(WayBlockReader, self).__init__(1, resume_from)
+        self.ways = []
+        # Ways before the time window, as (position in self.ways, id, version)
+        self.before = []
+        self.out_of_window = 0
+
+    def way(self, w):
+        if self.skip(w):
             return
-        query = """INSERT INTO ways VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}','{8}');"""
+        if inWindow(w.timestamp):
+            self.ways.append(wayRecord(w))
+            return
+        self.out_of_window += 1
+        if beforeWindow(w.timestamp) and any(node.ref in worker_index for node in w.nodes):
+            self.before.append((len(self.ways), w.id, w.version))
+
+    # Ways are resolved here too, with the index inherited from the main process.
+    # Ways before the time window with nodes in zone come with no rows, at
+    # their place in the file. Return them with the number of ways out of
+    # the time window, which are not returned otherwise.
+    def result(self):
+        resolved = dealWithWays(self.ways)
+        ways = []
+        start = 0
+        for position, id, version in self.before:
+            ways.extend(resolved[start:position])
+            ways.append((id, version, []))
+            start = position
+        ways.extend(resolved[start:])
+        return (ways, self.out_of_window - len(self.before))
+
+class RelationBlockReader(BlockReader):
+
+    def __init__(self, resume_from):
+        super(RelationBlockReader, self).__init__(2, resume_from)
+        self.relations = []
+        # Relations after the time window, which are not returned
+        self.late = 0
 
-        queries = Manager().list()
-        p = Process(target=processDealWithWay, args=(o,db,queries))
-        p.start()
-        p.join()
+    def relation(self, r):
+        if self.skip(r):
+            return
+        if inWindow(r.timestamp) or beforeWindow(r.timestamp):
+            self.relations.append(relationRecord(r))
+        else:
+            self.late += 1
 
-        # If all nodes were out of our zone we don't add the way
-        if len(queries) == 0:
-            logAction("Discarding a way, id: "+str(o.id))
-            ways_discarded +=1
-            return None
+    # Members are checked in the main process, where relations are kept
+    def result(self):
+        return (self.relations, self.late)
 
-        logAction("Adding a way, id: "+str(o.id))
-        queries.insert(0,query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""), o.jsontags))
+BLOCK_READERS = {NODE_TYPE: NodeBlockReader, WAY_TYPE: WayBlockReader, RELATION_TYPE: RelationBlockReader}
 
-        ways_added+=1
-        return queries
+# Decode a range of blocks: they are put after the file header in a buffer
+# which is read as a small PBF file of its own
+def decodeBlocks(task):
+    path, header, blocks, datatype, resume_from = task
+    data = [header]
+    with open(path, 'rb') as file:
+        for offset, size in blocks:
+            file.seek(offset)
+            data.append(file.read(size))
 
-    # Return am array of SQL commands to insert a relation
-    def insertRelationSQL(self,o):
+    reader = BLOCK_READERS[datatype](resume_from)
+    reader.apply_buffer(b''.join(data), 'osh.pbf')
+    return reader.result()
 
-        global relations_added, relations_discarded
+# ============= Importer class ==============
+
+class Importer(object):
 
-        if self.datatype!=RELATION_TYPE:
+    def __init__(self,datatype, db, writer, index, kept, resolver=None, zone=None, dictionary=None):
+        self.db = db
+        self.writer = writer
+        # Zone of the command line when None
+        self.zone = zone
+        self.dictionary = dictionary
+        # No node index when ways are resolved by sort-merge
+        self.index = index
+        self.kept = kept
+        self.datatype=datatype
+        self.resolver = resolver
+
+        # Nodes are filtered by batches
+        self.node_batch = NodeBatch()
+
+        # Ways are resolved by batches in the worker pool
+        self.pool = None
+        self.workers = 0
+        self.batch = []
+        self.pending_batch = None
+
+    # Deal with one entity (node, way or relation)
+    def add(self, o):
+
+        if self.datatype==NODE_TYPE:
+            self.node_batch.add(o)
+            if len(self.node_batch) >= NODE_BATCH_SIZE:
+                self.filterNodes()
+        elif self.datatype==WAY_TYPE:
+            self.addRecord(wayRecord(o))
+            return
+        elif self.datatype==RELATION_TYPE:
+            self.addRecord(relationRecord(o))
             return
+        else:
+            print('\033[91m'+"\nERROR: type"+str( self.datatype)+" not found, or not handled."+'\033[0m')
+            sys.exit(-1)
 
+        # Execute commands every 100000
+        if (self.writer.pending>100000):
+            self.executeCommands()
 
-        query = """INSERT INTO relations VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}','{8}');"""
+    # Deal with a way or a relation copied out of the file
+    def addRecord(self, record):
+        if self.datatype==WAY_TYPE and self.resolver != None:
+            self.resolver.addWay(record)
+        elif self.datatype==WAY_TYPE:
+            self.batch.append(record)
+            if len(self.batch) >= WORKER_BATCH_SIZE:
+                self.dispatchBatch()
+        else:
+            self.writeRelations([record])
 
-        queries = Manager().list()
-        p = Process(target=processDealWithRelation, args=(o,db,queries))
-        p.start()
-        p.join()
+        if (self.writer.pending>100000):
+            self.executeCommands()
 
-        if len (queries) == 0:
-            logAction("Discarding a relation, id: "+str(o.id))
-            relations_discarded +=1
-            return None
+    # Filter a batch of nodes shared with other zones
+    def addNodeBatch(self, batch):
+        self.writeNodes(filterNodeBatch(batch, self.zone))
 
-        logAction("Adding a relation, id: "+str(o.id))
-        queries.insert(0,query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""), o.jsontags))
+        if (self.writer.pending>100000):
+            self.executeCommands()
 
-        relations_added+=1
-        return queries
+    def executeCommands(self):
+        self.writer.flush()
+
+    # Write what a worker decoded from a range of blocks (see decodeBlocks)
+    def addDecoded(self, result):
+        if self.datatype==NODE_TYPE:
+            if result[0] > 0:
+                self.writeNodes(result)
+        elif self.datatype==WAY_TYPE:
+            self.writeWays(*result)
+        else:
+            self.writeRelations(*result)
+
+        if (self.writer.pending>100000):
+            self.executeCommands()
+
+    # Send the current batch to the workers, the parsing goes on meanwhile
+    def dispatchBatch(self):
+        # The previous batch is written first to keep the order of the file
+        self.collectBatch()
+        if len(self.batch) == 0:
+            return
+
+        size = -(-len(self.batch) // self.workers)
+        chunks = [self.batch[i:i+size] for i in range(0, len(self.batch), size)]
+        self.pending_batch = (self.batch, self.pool.map_async(dealWithWays, chunks))
+        self.batch = []
+
+    # Wait for the batch being resolved by the workers and write its rows
+    def collectBatch(self):
+        if self.pending_batch == None:
+            return
+        records, result = self.pending_batch
+        self.pending_batch = None
+        self.writeWays(list(chain.from_iterable(result.get())))
+
+    # Write the resolved ways given as (id, version, rows or None), out_of_window
+    # ways more were dropped while decoding them
+    def writeWays(self, ways, out_of_window=0):
+        added = 0
+        before = 0
+        for id, version, rows in ways:
+            if rows == None:
+                continue
+            self.kept.ways.add(id)
+            if len(rows) == 0:
+                before += 1
+                continue
+            added += 1
+            for table, row in rows:
+                self.writeRow(table, row)
+
+        metrics.count('ways_added', added)
+        metrics.discard('ways', 'no_node_in_zone', len(ways) - added - before)
+        if before + out_of_window > 0:
+            metrics.discard('ways', 'out_of_window', before + out_of_window)
+        if len(ways) > 0:
+            self.writer.checkpoint.set('w', ways[-1][0], ways[-1][1])
+
+    # Resolve what is left in the batches and write everything
+    def finish(self):
+        self.filterNodes()
+        self.dispatchBatch()
+        self.collectBatch()
+        if self.resolver != None and len(self.resolver) > 0:
+            self.resolveWays()
+        self.executeCommands()
+
+    # Resolve all the ways received so far by sort-merge, the kept
+    # nodes have to be committed first as they are read from the database
+    def resolveWays(self):
+        self.writer.sync()
+        logStep("Resolving "+str(len(self.resolver))+" way nodes by sort-merge...")
+        ways = []
+        for way in self.resolver.resolve():
+            ways.append(way)
+            if len(ways) >= WORKER_BATCH_SIZE:
+                self.writeWays(ways)
+                ways = []
+                if (self.writer.pending>100000):
+                    self.executeCommands()
+        self.writeWays(ways)
+
+    # Discard the nodes of the batch which are not in the zone, write the others
+    def filterNodes(self):
+        if len(self.node_batch) == 0 and self.node_batch.late == 0:
+            return
+        self.writeNodes(filterNodeBatch(self.node_batch, self.zone))
+        self.node_batch.clear()
+
+    # Write the nodes of a batch filtered by filterNodeBatch
+    def writeNodes(self, filtered):
+        count, out_of_window, kept, rows, last = filtered
+        metrics.count('nodes_added', len(rows))
+        metrics.discard('nodes', 'out_of_zone', count - out_of_window - len(rows))
+        if out_of_window > 0:
+            metrics.discard('nodes', 'out_of_window', out_of_window)
+
+        if kept == None:
+            return
+        if self.index != None:
+            self.index.addMany(*kept)
+        else:
+            self.kept.nodes.addMany(kept[0])
+        for row in rows:
+            self.writeRow('nodes', row)
+
+        self.writer.checkpoint.set('n', last[0], last[1])
+
+    # Write the relations with members in zone, late relations more were
+    # dropped while decoding them
+    def writeRelations(self, records, late=0):
+        added = 0
+        out_of_window = 0
+        if late > 0:
+            metrics.discard('relations', 'out_of_window', late)
+        for record in records:
+            # Decoded by a worker, see RelationBlockReader
+            if not inWindow(record.timestamp):
+                self.discardOutOfWindow(record.id, record.timestamp, ((type, ref) for type, ref, role in record.members))
+                self.writer.checkpoint.set('r', record.id, record.version)
+                out_of_window += 1
+                continue
+            rows = self.relationRows(record)
+            if rows != None:
+                added += 1
+                for table, row in rows:
+                    self.writeRow(table, row)
+            self.writer.checkpoint.set('r', record.id, record.version)
+
+        metrics.count('relations_added', added)
+        metrics.discard('relations', 'no_member_in_zone', len(records) - added - out_of_window)
+
+    # Discard a way or a relation out of the time window before it is copied
+    # out of the file. As in a full import, the ids of the ones created before
+    # the window with members in zone are kept: relations may refer to them.
+    def discardOutOfWindow(self, id, timestamp, members):
+        if self.datatype == WAY_TYPE:
+            metrics.discard('ways', 'out_of_window')
+            if beforeWindow(timestamp) and any(ref in self.kept.nodes for ref in members):
+                self.kept.ways.add(id)
+        else:
+            metrics.discard('relations', 'out_of_window')
+            if beforeWindow(timestamp) and any(self.kept.contains(type, ref) for type, ref in members):
+                self.kept.relations.add(id)
+
+    def writeRow(self, table, row):
+        if self.dictionary != None and table in NORMALIZED_TABLES:
+            row = self.dictionary.encode(row, self.writer)
+        self.writer.add(table, row)
+
+    # Return the rows to insert a relation and its members, or None if no member is in zone
+    def relationRows(self,o):
+
+        rows = [('relations', (o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user,tagsValue(o.tags)))]
+
+        sequence_id = 0
+        for type, ref, role in o.members:
+            # Both nodes and ways imports make sure that entities are in zone,
+            # so members in zone are the ones kept so far
+            if not self.kept.contains(type, ref):
+                continue
+            rows.append( ('relations_members', (o.id,o.version,ref,type,role,sequence_id)) )
+            sequence_id += 1
+
+        if sequence_id == 0:
+            return None
+
+        self.kept.relations.add(o.id)
+        return rows
 
 class FileHandler(o.SimpleHandler):
-    def __init__(self, db):
+    def __init__(self, db, writer, workers, single_pass=False, parallel=False, resolver='index', zone=None):
         super(FileHandler, self).__init__()
-        self.nodes = Importer(NODE_TYPE,db)
-        self.ways = Importer(WAY_TYPE,db)
-        self.rels = Importer(RELATION_TYPE,db)
-        # We start with node
-        self.current_type=NODE_TYPE
+        self.db = db
+        self.writer = writer
+        # (bottom left, top right), the zone of the command line when None
+        self.zone = zone
+        # User names and tags interned for this database when normalizing
+        self.dictionary = Dictionary() if NORMALIZE else None
+        if resolver == 'sortmerge':
+            # Only the ids of kept nodes are kept in memory
+            self.index = None
+            self.kept = KeptIds(IdSet())
+            self.resolver = SortMergeResolver(db)
+        else:
+            # Versions of the kept nodes, used to resolve the nodes of ways
+            self.index = NodeVersionIndex()
+            # Ids of kept entities, used to check the members of relations
+            self.kept = KeptIds(self.index)
+            self.resolver = None
+        self.nodes = Importer(NODE_TYPE,db,writer,self.index,self.kept,None,zone,self.dictionary)
+        self.ways = Importer(WAY_TYPE,db,writer,self.index,self.kept,self.resolver,zone,self.dictionary)
+        self.rels = Importer(RELATION_TYPE,db,writer,self.index,self.kept,None,zone,self.dictionary)
+        self.workers = workers
+        self.pool = None
+        # In single pass mode, phases are switched when the type of entities
+        # changes in the file (history files are sorted nodes, ways, relations)
+        self.single_pass = single_pass
+        self.current_type=None
+        # In parallel mode, the workers decode the file (see applyParallel)
+        self.parallel = parallel
+        # On resume, entities up to this (rank, id, version) are already imported
+        self.resume_from = None
+        # When applying changes, latest imported version of each node, way and relation
+        self.imported = None
 
     def node(self, n):
+        if self.resume_from != None and self.skip(0, n):
+            return
         if(self.current_type == NODE_TYPE):
-            self.nodes.add(n)
+            if self.imported == None or not self.isImported(0, n):
+                self.nodes.add(n)
+        elif self.single_pass:
+            print('\033[91m'+"\nERROR: node "+str(n.id)+" found after ways or relations, the file is not sorted."+'\033[0m')
+            sys.exit(-1)
 
     def way(self, w):
+        if self.resume_from != None and self.skip(1, w):
+            return
+        if self.single_pass and self.current_type == NODE_TYPE:
+            self.startPhase(WAY_TYPE)
         if(self.current_type == WAY_TYPE):
-	        self.ways.add(w)
+            if not inWindow(w.timestamp):
+                self.ways.discardOutOfWindow(w.id, w.timestamp, (node.ref for node in w.nodes))
+            elif self.imported == None or not self.isImported(1, w):
+                self.ways.add(w)
 
     def relation(self, r):
+        if self.resume_from != None and self.skip(2, r):
+            return
+        if self.single_pass and self.current_type != RELATION_TYPE:
+            self.startPhase(RELATION_TYPE)
         if self.current_type == RELATION_TYPE:
-	        self.rels.add(r)
+            if not inWindow(r.timestamp):
+                self.rels.discardOutOfWindow(r.id, r.timestamp, ((member.type, member.ref) for member in r.members))
+            elif self.imported == None or not self.isImported(2, r):
+                self.rels.add(r)
+
+    # Write what is left of the previous phase, so that the next one
+    # can rely on it, and start importing entities of the given type
+    def startPhase(self, datatype):
+        self.switchPhase(datatype)
+        logPhase("Parsing and importing "+datatype.lower()+"...")
+        metrics.setPhase(datatype)
+
+    def switchPhase(self, datatype):
+        self.finish_remaining_commands()
+        if self.parallel:
+            # Workers decoding the file need the state of the previous phases
+            self.closePool()
+            self.startPool()
+        elif datatype != NODE_TYPE and self.pool == None and self.resolver == None:
+            self.startPool()
+        self.current_type = datatype
+        self.writer.checkpoint.phase = datatype
+
+    def skip(self, rank, o):
+        if (rank, o.id, o.version) <= self.resume_from:
+            return True
+        # History files are sorted, nothing further has to be skipped
+        self.resume_from = None
+        return False
+
+    # Continue after the checkpoint: rebuild the node index and the kept ids
+    # from the imported tables, and skip the entities up to the checkpoint
+    def resume(self, checkpoint):
+        self.resume_from = checkpoint.position()
+
+        # Rows committed after the checkpoint are written again
+        commands = []
+        for table in reversed(TABLES):
+            if self.resume_from == None or TABLE_RANKS[table] > self.resume_from[0]:
+                commands.append("DELETE FROM "+self.db.tables[table])
+            elif TABLE_RANKS[table] == self.resume_from[0]:
+                commands.append("DELETE FROM "+self.db.tables[table]+" WHERE (id, version) > ("+str(checkpoint.id)+", "+str(checkpoint.version)+")")
+        self.db.execute(commands)
+        self.loadImported()
+
+        if self.resume_from == None:
+            logStep("Resuming from the start of the file")
+        else:
+            logStep("Resuming after "+checkpoint.type+" "+str(checkpoint.id)+" v"+str(checkpoint.version)+
+                ", "+str(len(self.kept.nodes))+" nodes, "+str(len(self.kept.ways))+" ways and "+
+                str(len(self.kept.relations))+" relations already imported")
+
+    # Apply change files on top of the imported tables: rebuild the node
+    # index and the kept ids, and skip the versions already imported
+    def startChanges(self, files):
+        changes = ChangeIds()
+        for path in files:
+            changes.apply_file(path)
+        ids_tables = {}
+        for table, ids in changes.tables():
+            ids_tables[table] = 'change_ids_'+table
+            loadIdsTable(self.db, ids_tables[table], ids)
+        if self.resolver != None:
+            self.resolver.ids_table = ids_tables['nodes']
+        self.loadImported(ids_tables)
+        self.imported = []
+        for table in ['nodes', 'ways', 'relations']:
+            latest = LatestVersions()
+            latest.load(self.db, self.db.tables[table], ids_tables[table])
+            self.imported.append(latest)
+        logStep("Applying changes, "+str(len(self.kept.nodes))+" nodes, "+str(len(self.kept.ways))+" ways and "+
+            str(len(self.kept.relations))+" relations they refer to already imported")
+
+    def isImported(self, rank, o):
+        if self.imported[rank].contains(o.id, o.version):
+            metrics.discard(['nodes', 'ways', 'relations'][rank], 'already_imported')
+            return True
+        return False
+
+    # Read the imported entities back: the node index (or the ids of
+    # kept nodes), the ids of kept ways and relations and the dictionary.
+    # With ids_tables, only the entities of these temporary tables are read.
+    def loadImported(self, ids_tables={}):
+        if self.index != None:
+            cur = self.db.connection.cursor('resume_nodes')
+            cur.itersize = NODE_BATCH_SIZE
+            cur.execute("SELECT id, version, extract(epoch from created_at)::bigint, latitude, longitude FROM "+self.db.tables['nodes']+joinIds(ids_tables.get('nodes'))+" ORDER BY id, created_at")
+            while True:
+                rows = cur.fetchmany(NODE_BATCH_SIZE)
+                if len(rows) == 0:
+                    break
+                columns = np.array(rows, dtype=np.int64).T
+                self.index.addMany(columns[0], columns[1], columns[2], columns[3], columns[4])
+            cur.close()
+            kept_ids = []
+        else:
+            kept_ids = [('nodes', self.kept.nodes)]
 
-    def finish_remaining_commands(self):
-        self.nodes.executeCommands()
-        self.ways.executeCommands()
-        self.rels.executeCommands()
+        if self.dictionary != None:
+            self.dictionary.load(self.db)
 
-# Make sure given point is in defined zone
-def checkBoundary(x,y):
-    return (x>=BOTTOM_LEFT_BOUNDARY[1] and x<=TOP_RIGHT_BOUNDARY[1] and
-        y>=BOTTOM_LEFT_BOUNDARY[0] and y <= TOP_RIGHT_BOUNDARY[0])
+        for table, ids in kept_ids + [('ways', self.kept.ways), ('relations', self.kept.relations)]:
+            cur = self.db.connection.cursor('resume_'+table)
+            cur.itersize = NODE_BATCH_SIZE
+            cur.execute("SELECT DISTINCT id FROM "+self.db.tables[table]+joinIds(ids_tables.get(table))+" ORDER BY id")
+            for row in cur:
+                ids.add(row[0])
+            cur.close()
+        self.db.connection.commit()
+
+    # Start the workers resolving ways. They are forked from
+    # this process, so this has to be done once the nodes are imported.
+    def startPool(self):
+        global worker_index
+        # Sorted once here rather than in every worker
+        if self.index != None and not self.index.sorted:
+            self.index.sort()
+        worker_index = self.index
+        self.pool = get_context('fork').Pool(self.workers)
+        self.ways.pool = self.pool
+        self.ways.workers = self.workers
+
+    def closePool(self):
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    # Decode the file by ranges of blocks in the worker pool, and write
+    # the results in the order of the file
+    def applyParallel(self, path):
+        importer = {NODE_TYPE: self.nodes, WAY_TYPE: self.ways, RELATION_TYPE: self.rels}[self.current_type]
+        header, blocks = pbfBlocks(path)
+
+        pending = deque()
+        for i in range(0, len(blocks), READ_BLOCKS_PER_TASK):
+            task = (path, header, blocks[i:i+READ_BLOCKS_PER_TASK], self.current_type, self.resume_from)
+            size = sum(size for offset, size in task[2]) + (len(header) if i == 0 else 0)
+            pending.append((size, self.pool.apply_async(decodeBlocks, (task,))))
+            # Bound the results waiting to be written
+            if len(pending) >= 2*self.workers:
+                self.addDecoded(importer, pending.popleft())
+        while len(pending) > 0:
+            self.addDecoded(importer, pending.popleft())
+        self.resume_from = None
+
+    def addDecoded(self, importer, task):
+        size, result = task
+        importer.addDecoded(result.get())
+        metrics.count('bytes_read', size)
+
+    # Read the file for the current phase
+    def read(self, path):
+        if self.parallel:
+            self.applyParallel(path)
+        else:
+            self.apply_file(path)
+            metrics.count('bytes_read', os.path.getsize(path))
 
-def logAction(action):
-    global actionsLogged, nodes_added,nodes_discarded, ways_added, ways_discarded, relations_added, relations_discarded,lastActionLogged
+    def finish_remaining_commands(self):
+        self.nodes.finish()
+        self.ways.finish()
+        self.rels.finish()
+
+# Writer of the rows of a database, depending on the command line options
+def openWriter(db, copy_mode, pool_size, pipeline=False):
+    if pool_size != None:
+        return PoolWriter(db, binary=(copy_mode == 'binary'), pool_size=pool_size)
+    elif pipeline:
+        return PipelineWriter(db, binary=(copy_mode == 'binary'))
+    elif copy_mode:
+        return CopyWriter(db, binary=(copy_mode == 'binary'))
+    return InsertWriter(db)
+
+class MultiZoneHandler(o.SimpleHandler):
+    """read the file once for several zones, each one imported by its own
+    FileHandler (and written to its own database or schema).
+
+    Entities are copied out of the file once: nodes are batched here and
+    each zone filters the same batch, ways and relations are given to every
+    zone as records."""
+
+    def __init__(self, handlers, single_pass=False):
+        super(MultiZoneHandler, self).__init__()
+        self.handlers = handlers
+        self.node_batch = NodeBatch()
+        self.single_pass = single_pass
+        self.current_type = None
 
-    if lastActionLogged==0:
-        lastActionLogged = time.time()
+    def node(self, n):
+        if self.current_type == NODE_TYPE:
+            self.node_batch.add(n)
+            if len(self.node_batch) >= NODE_BATCH_SIZE:
+                self.filterNodes()
+        elif self.single_pass:
+            print('\033[91m'+"\nERROR: node "+str(n.id)+" found after ways or relations, the file is not sorted."+'\033[0m')
+            sys.exit(-1)
 
-    actionsLogged += 1
+    def way(self, w):
+        if self.single_pass and self.current_type == NODE_TYPE:
+            self.startPhase(WAY_TYPE)
+        if self.current_type == WAY_TYPE and not inWindow(w.timestamp):
+            for handler in self.handlers:
+                handler.ways.discardOutOfWindow(w.id, w.timestamp, (node.ref for node in w.nodes))
+        elif self.current_type == WAY_TYPE:
+            record = wayRecord(w)
+            for handler in self.handlers:
+                handler.ways.addRecord(record)
 
-    if actionsLogged % 1000 == 0 or time.time() - lastActionLogged > 60:
-        file = open("logs/"+DB_NAME+"-log.txt","a")
-        file.write('\n'+str(actionsLogged)+" | "+action)
-        file.write("\nNodes added: "+str(nodes_added)+"\nNodes discarded: "+str(nodes_discarded)+
-         "\nWays added: "+str(ways_added)+ "\nWays discarded: " + str(ways_discarded) +
-         "\nRelations added: "+str(relations_added) + "\nRelations discarded: "+ str(relations_discarded)+"\n")
+    def relation(self, r):
+        if self.single_pass and self.current_type != RELATION_TYPE:
+            self.startPhase(RELATION_TYPE)
+        if self.current_type == RELATION_TYPE and not inWindow(r.timestamp):
+            for handler in self.handlers:
+                handler.rels.discardOutOfWindow(r.id, r.timestamp, ((member.type, member.ref) for member in r.members))
+        elif self.current_type == RELATION_TYPE:
+            record = relationRecord(r)
+            for handler in self.handlers:
+                handler.rels.addRecord(record)
+
+    def filterNodes(self):
+        if len(self.node_batch) == 0:
+            return
+        for handler in self.handlers:
+            handler.nodes.addNodeBatch(self.node_batch)
+        self.node_batch.clear()
+
+    def startPhase(self, datatype):
+        self.filterNodes()
+        for handler in self.handlers:
+            handler.switchPhase(datatype)
+        logPhase("Parsing and importing "+datatype.lower()+" for "+str(len(self.handlers))+" zones...")
+        metrics.setPhase(datatype)
+        self.current_type = datatype
+
+    def read(self, path):
+        self.apply_file(path)
+        metrics.count('bytes_read', os.path.getsize(path))
+
+    def finish_remaining_commands(self):
+        self.filterNodes()
+        for handler in self.handlers:
+            handler.finish_remaining_commands()
+
+    def closePool(self):
+        for handler in self.handlers:
+            handler.closePool()
+
+# Read a zones file: one zone per line, "<name> <bottom left x> <bottom left y>
+# <top right x> <top right y> [<dbname>]", or "<name> <GeoJSON file> [<dbname>]"
+# for a polygon zone. Rows of a zone go to the tables of the schema <name> of
+# the database of the command line, or to the tables of the database <dbname>
+# when given.
+def readZones(path):
+    zones = []
+    try:
+        file = open(path)
+        lines = file.read().splitlines()
         file.close()
-        lastActionLogged = time.time()
+    except OSError as error:
+        print('\033[91m'+"Unable to read the zones file: "+str(error)+'\033[0m')
+        sys.exit(-1)
+    for number, line in enumerate(lines, 1):
+        fields = line.split('#', 1)[0].split()
+        if len(fields) == 0:
+            continue
+        if len(fields) in [2, 3] and fields[0].isidentifier():
+            # GeoJSON files are relative to the zones file
+            zone = readPolygonZone(os.path.join(os.path.dirname(path), fields[1]))
+            zones.append((fields[0].lower(), zone, fields[2] if len(fields) == 3 else None))
+            continue
+        try:
+            if len(fields) not in [5, 6] or not fields[0].isidentifier():
+                raise ValueError(line)
+            bottom_left = [int(fields[1]), int(fields[2])]
+            top_right = [int(fields[3]), int(fields[4])]
+        except ValueError:
+            print('\033[91m'+"Invalid zone at line "+str(number)+" of "+path+": "+line+'\033[0m')
+            sys.exit(-1)
+        zones.append((fields[0].lower(), (bottom_left, top_right), fields[5] if len(fields) == 6 else None))
+    if len(zones) == 0:
+        print('\033[91m'+"No zone in "+path+"."+'\033[0m')
+        sys.exit(-1)
+    return zones
+
+# Extract "--name" or "--name=value" from the command line arguments
+def getOption(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg == '--'+name:
+            sys.argv.remove(arg)
+            return True
+        if arg.startswith('--'+name+'='):
+            sys.argv.remove(arg)
+            return arg.split('=',1)[1]
+    return default
+
+# Parse a date of the command line, "2020-01-31" or "2020-01-31T12:00:00"
+# (UTC unless an offset is given), as seconds since the epoch
+def parseDate(option, value):
+    try:
+        if value.endswith('Z'):
+            value = value[:-1]
+        moment = datetime.fromisoformat(value)
+    except (AttributeError, ValueError):
+        print('\033[91m'+"Invalid date for --"+option+": "+str(value)+", use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS."+'\033[0m')
+        sys.exit(-1)
+    if moment.tzinfo == None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+# Change files of a directory in the order of their sequence numbers
+# (replication directories are like 000/123/456.osc.gz), or the given file
+def changeFiles(path):
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for directory, _, names in os.walk(path):
+        for name in names:
+            if name.endswith('.osc') or name.endswith('.osc.gz') or name.endswith('.osc.bz2'):
+                files.append(os.path.join(directory, name))
+    if len(files) == 0:
+        print('\033[91m'+"No change file (.osc, .osc.gz or .osc.bz2) found in "+path+"."+'\033[0m')
+        sys.exit(-1)
+    return sorted(files)
+
+# Print the start of a new phase to output and to the log file
+def logPhase(message):
+    file = open("logs/"+DB_NAME+"-log.txt","a")
+    file.write("\n\n------------------------------\n"+message)
+    file.write("\nTime elapsed: "+str(time.time()-starting_time))
+    file.close()
+    print(message)
+    print("Time elapsed: "+str(time.time()-starting_time))
 
+# Print a step to output and to the log file
+def logStep(message):
+    file = open("logs/"+DB_NAME+"-log.txt","a")
+    file.write("\n"+message)
+    file.close()
+    print(message)
 
 if __name__ == '__main__':
 
@@ -498,11 +2930,134 @@ if __name__ == '__main__':
 
     starting_time = time.time()
 
+    # Options: --copy (COPY text format) or --copy=binary,
+    # --workers=<n> number of processes resolving ways,
+    # --single-pass to read the file once instead of once per entity type,
+    # --resume to continue an interrupted import after its last checkpoint,
+    # --parallel to decode the file in the worker processes,
+    # --pool-size=<n> to load tables concurrently on n connections,
+    # --resolver=sortmerge to resolve way nodes without the in-memory index,
+    # --sink=sqlite:<file> or --sink=csv:<directory> to write the rows
+    # somewhere else than the PostgreSQL database,
+    # --normalize to store user names and tags in dictionary tables,
+    # --changes to apply .osc change files (a file or a directory of them)
+    # to a previous import,
+    # --zones=<file> to import several zones in one read of the file,
+    # --polygon=<file> to use the polygons of a GeoJSON file as the zone,
+    # --since=<date> and --until=<date> to only import the versions created
+    # in this time window,
+    # --pipeline to load the rows with COPY in a thread while parsing goes on,
+    # --geometries to also store the line of each way version as WKB,
+    # --sort[=<megabytes>] to sort unordered or merged files (several files
+    # separated by commas) first, with this much memory (256 by default)
+    copy_mode = getOption('copy')
+    workers = getOption('workers', True)
+    single_pass = getOption('single-pass', False)
+    BULK_LOAD = getOption('bulk', False)
+    RESUME = getOption('resume', False)
+    parallel = getOption('parallel', False)
+    pool_size = getOption('pool-size')
+    resolver = getOption('resolver', 'index')
+    sink = getOption('sink', 'postgresql')
+    normalize = getOption('normalize', False)
+    changes = getOption('changes', False)
+    zones_file = getOption('zones')
+    polygon_file = getOption('polygon')
+    since = getOption('since')
+    until = getOption('until')
+    pipeline = getOption('pipeline', False)
+    geometries = getOption('geometries', False)
+    sort = getOption('sort', False)
+
     if len(sys.argv) < 2:
-        print("Usage: python osm-importer.py <osmfile>")
+        print("Usage: python osm-importer.py <osmfile> [--copy[=binary]] [--workers=<n>] [--single-pass] [--bulk] [--resume] [--parallel] [--pool-size[=<n>]] [--resolver=index|sortmerge] [--sink=postgresql|sqlite:<file>|csv:<directory>] [--normalize] [--changes] [--zones=<file>] [--polygon=<file>] [--since=<date>] [--until=<date>] [--pipeline] [--geometries] [--sort[=<megabytes>]]")
         sys.exit(-1)
 
-    print(orange+"\nWarning: All single quote ' are deleted in tags and users'name"+white)
+    # One worker per CPU by default, as with a bare --workers
+    if workers == True:
+        workers = os.cpu_count()
+    elif not workers.isdigit() or int(workers) < 1:
+        print('\033[91m'+"--workers needs a number of workers, at least 1."+'\033[0m')
+        sys.exit(-1)
+    else:
+        workers = int(workers)
+
+    if resolver not in ['index', 'sortmerge']:
+        print('\033[91m'+"Unknown resolver: "+str(resolver)+", use index or sortmerge."+'\033[0m')
+        sys.exit(-1)
+    if parallel and resolver == 'sortmerge':
+        print('\033[91m'+"--parallel resolves ways with the node index, it can't be used with --resolver=sortmerge."+'\033[0m')
+        sys.exit(-1)
+
+    sink_type, _, sink_path = sink.partition(':')
+    if sink_type not in ['postgresql', 'sqlite', 'csv'] or (sink_type != 'postgresql' and sink_path == ''):
+        print('\033[91m'+"Unknown sink: "+str(sink)+", use postgresql, sqlite:<file> or csv:<directory>."+'\033[0m')
+        sys.exit(-1)
+    if sink_type != 'postgresql':
+        # These options need the rows to be in a PostgreSQL database
+        for option, used in [('--bulk', BULK_LOAD), ('--resume', RESUME), ('--pool-size', pool_size != None), ('--resolver=sortmerge', resolver == 'sortmerge'), ('--copy', copy_mode)]:
+            if used:
+                print('\033[91m'+option+" can't be used with --sink="+sink_type+"."+'\033[0m')
+                sys.exit(-1)
+
+    if changes:
+        # Changes are appended to the final tables of a previous import
+        for option, used in [('--bulk', BULK_LOAD), ('--resume', RESUME), ('--parallel', parallel), ('--single-pass', single_pass), ('--sink='+sink_type, sink_type != 'postgresql')]:
+            if used:
+                print('\033[91m'+option+" can't be used with --changes."+'\033[0m')
+                sys.exit(-1)
+
+    if zones_file != None:
+        # Zones are imported by reading the file once per phase, in this process
+        for option, used in [('--resume', RESUME), ('--changes', changes), ('--parallel', parallel), ('--sink='+sink_type, sink_type != 'postgresql'), ('--polygon', polygon_file != None)]:
+            if used:
+                print('\033[91m'+option+" can't be used with --zones."+'\033[0m')
+                sys.exit(-1)
+
+    if pipeline:
+        # Loading in threads is what --pool-size does, with more connections
+        for option, used in [('--pool-size', pool_size != None), ('--sink='+sink_type, sink_type != 'postgresql')]:
+            if used:
+                print('\033[91m'+option+" can't be used with --pipeline."+'\033[0m')
+                sys.exit(-1)
+
+    if since != None:
+        SINCE = parseDate('since', since)
+        # The node versions before the window are only kept in the node index
+        for option, used in [('--resume', RESUME), ('--changes', changes), ('--resolver=sortmerge', resolver == 'sortmerge')]:
+            if used:
+                print('\033[91m'+option+" can't be used with --since."+'\033[0m')
+                sys.exit(-1)
+    if until != None:
+        UNTIL = parseDate('until', until)
+    if SINCE != None and UNTIL != None and SINCE >= UNTIL:
+        print('\033[91m'+"--since has to be before --until."+'\033[0m')
+        sys.exit(-1)
+
+    if sort:
+        if sort != True:
+            SORT_MEMORY = int(sort)*1024*1024
+        if changes:
+            print('\033[91m'+"Change files are applied in the order of their sequence numbers, --sort can't be used with --changes."+'\033[0m')
+            sys.exit(-1)
+
+    if normalize:
+        normalizeTables()
+    if geometries:
+        geometriesTable()
+
+    # At least one connection per table, one each by default
+    if pool_size == True:
+        pool_size = len(TABLES)
+    elif pool_size != None:
+        pool_size = int(pool_size)
+        if pool_size < len(TABLES):
+            print('\033[91m'+"--pool-size needs at least one connection per table ("+str(len(TABLES))+")."+'\033[0m')
+            sys.exit(-1)
+
+    if parallel and single_pass:
+        print('\033[91m'+"--parallel reads the file once per entity type, it can't be used with --single-pass."+'\033[0m')
+        sys.exit(-1)
 
     # Create connection with db
     if (not sys.argv[2] ):
@@ -513,80 +3068,152 @@ if __name__ == '__main__':
     else:
         DB_NAME = sys.argv[2]
 
-    print("\nConnecting to db... ")
-    db = DB()
+    # Database, writer and zone of each output, zone being None for
+    # the zone of the command line
+    outputs = []
+    if sink_type == 'sqlite':
+        print("\nOpening "+sink_path+"... ")
+        outputs.append((None, SQLiteWriter(sink_path), None))
+    elif sink_type == 'csv':
+        print("\nWriting CSV files in "+sink_path+"... ")
+        outputs.append((None, CsvWriter(sink_path), None))
+    elif zones_file != None:
+        zones = readZones(zones_file)
+        print("\nConnecting to db for "+str(len(zones))+" zones... ")
+        for name, zone, zone_db_name in zones:
+            db = DB(zone_db_name) if zone_db_name != None else DB(None, name)
+            if BULK_LOAD:
+                db.setBulkSession()
+            outputs.append((db, openWriter(db, copy_mode, pool_size, pipeline), zone))
+    else:
+        print("\nConnecting to db... ")
+        db = DB()
+        if BULK_LOAD:
+            db.setBulkSession()
+        outputs.append((db, openWriter(db, copy_mode, pool_size, pipeline), None))
+    for db, writer, zone in outputs:
+        writer.checkpoint = Checkpoint(sys.argv[1])
+        if db != None and not RESUME:
+            writer.checkpoint.reset(db)
+    # Only imports of a single zone can be resumed
+    db, writer, zone = outputs[0]
+    checkpoint = writer.checkpoint
+    resumed = False
+    if RESUME:
+        resumed = checkpoint.load(db)
+        if not resumed:
+            print(orange+"No checkpoint found, starting from the beginning."+white)
+        elif checkpoint.phase == "Done":
+            print(green+"This import is already finished."+white)
+            sys.exit(0)
     print("OK")
 
     #  Set up zone limit
-    print("Setting up the zone limit...")
-    if len(sys.argv) < 6:
-        if sys.version_info[0] < 3:
-            BOTTOM_LEFT_BOUNDARY[0] = int(raw_input("Please enter bottom left boundary x:"))
-            BOTTOM_LEFT_BOUNDARY[1] = int(raw_input("Please enter bottom left boundary y:"))
-            TOP_RIGHT_BOUNDARY[0] = int(raw_input("Please enter top right boundary x:"))
-            TOP_RIGHT_BOUNDARY[1] = int(raw_input("Please enter top right boundary y:"))
+    if polygon_file != None:
+        print("Setting up the polygon zone...")
+        ZONE_POLYGON = readPolygonZone(polygon_file)
+        print("OK")
+    elif zones_file == None:
+        print("Setting up the zone limit...")
+        if len(sys.argv) < 6:
+            if sys.version_info[0] < 3:
+                BOTTOM_LEFT_BOUNDARY[0] = int(raw_input("Please enter bottom left boundary x:"))
+                BOTTOM_LEFT_BOUNDARY[1] = int(raw_input("Please enter bottom left boundary y:"))
+                TOP_RIGHT_BOUNDARY[0] = int(raw_input("Please enter top right boundary x:"))
+                TOP_RIGHT_BOUNDARY[1] = int(raw_input("Please enter top right boundary y:"))
+            else:
+                BOTTOM_LEFT_BOUNDARY[0] = int(input("Please enter bottom left boundary x:"))
+                BOTTOM_LEFT_BOUNDARY[1] = int(input("Please enter bottom left boundary y:"))
+                TOP_RIGHT_BOUNDARY[0] = int(input("Please enter top right boundary x:"))
+                TOP_RIGHT_BOUNDARY[1] = int(input("Please enter top right boundary y:"))
         else:
-            BOTTOM_LEFT_BOUNDARY[0] = int(input("Please enter bottom left boundary x:"))
-            BOTTOM_LEFT_BOUNDARY[1] = int(input("Please enter bottom left boundary y:"))
-            TOP_RIGHT_BOUNDARY[0] = int(input("Please enter top right boundary x:"))
-            TOP_RIGHT_BOUNDARY[1] = int(input("Please enter top right boundary y:"))
-    else:
-        BOTTOM_LEFT_BOUNDARY[0] = int(sys.argv[3])
-        BOTTOM_LEFT_BOUNDARY[1] = int(sys.argv[4])
-        TOP_RIGHT_BOUNDARY[0] = int(sys.argv[5])
-        TOP_RIGHT_BOUNDARY[1] = int(sys.argv[6])
-    print("OK")
+            BOTTOM_LEFT_BOUNDARY[0] = int(sys.argv[3])
+            BOTTOM_LEFT_BOUNDARY[1] = int(sys.argv[4])
+            TOP_RIGHT_BOUNDARY[0] = int(sys.argv[5])
+            TOP_RIGHT_BOUNDARY[1] = int(sys.argv[6])
+        print("OK")
 
     print("Output will be in : logs/"+DB_NAME+"-log.txt")
 
-    file = open("logs/"+DB_NAME+"-log.txt","w")
-
-    # Parse file and importing
-    file.write("\n\n------------------------------\nParsing and importing nodes...")
-    file.write("\nTime elapsed: "+str(time.time()-starting_time))
+    # The log of the interrupted import is continued
+    file = open("logs/"+DB_NAME+"-log.txt","a" if resumed else "w")
     file.close()
-    print("Parsing and importing nodes...")
-    print("Time elapsed: "+str(time.time()-starting_time))
-    n = FileHandler(db)
-    n.apply_file(sys.argv[1])
-    n.finish_remaining_commands()
 
-    file = open("logs/"+DB_NAME+"-log.txt","a")
-    file.write("\n\n------------------------------\nParsing and importing ways...")
-    file.write("\nTime elapsed: "+str(time.time()-starting_time))
+    # Snapshots of the metrics, one JSON object per line
+    print("Metrics will be in : logs/"+DB_NAME+"-metrics.jsonl")
+    file = open("logs/"+DB_NAME+"-metrics.jsonl","a" if resumed else "w")
     file.close()
-    print("Parsing and importing ways...")
-    print("Time elapsed: "+str(time.time()-starting_time))
-    n.current_type = WAY_TYPE
-    n.apply_file(sys.argv[1])
-    n.finish_remaining_commands()
+    reporter = MetricsReporter("logs/"+DB_NAME+"-metrics.jsonl")
+    reporter.start()
+
+    # Sort the input into a temporary file, imported instead
+    files = [sys.argv[1]]
+    sorted_path = None
+    if sort:
+        logPhase("Sorting "+sys.argv[1]+"...")
+        metrics.setPhase("Sorting")
+        sorted_path = sortFiles(sys.argv[1].split(','))
+        files = [sorted_path]
 
-    # file = open("logs/"+DB_NAME+"-log.txt","a")
-    # file.write("\n\n------------------------------\nParsing and importing relations... ")
-    # file.write("\nTime elapsed: "+str(time.time()-starting_time))
-    # file.close()
-    # print("Parsing and importing relations..")
-    # print("Time elapsed: "+str(time.time()-starting_time))
-    # n.current_type = RELATION_TYPE
-    # n.apply_file(sys.argv[1])
-    # n.finish_remaining_commands()
-    print("Skipping relations imports")
+    # Parse file and importing
+    if zones_file != None:
+        # The workers are shared out between the zones
+        zone_workers = max(1, workers // len(outputs))
+        n = MultiZoneHandler([FileHandler(db, writer, zone_workers, single_pass, False, resolver, zone) for db, writer, zone in outputs], single_pass)
+    else:
+        n = FileHandler(db, writer, workers, single_pass, parallel, resolver)
+    phases = [NODE_TYPE, WAY_TYPE, RELATION_TYPE]
+    if resumed:
+        # Phases before the checkpoint are not read again
+        phases = phases[phases.index(checkpoint.phase):]
+        n.resume(checkpoint)
+    elif changes:
+        files = changeFiles(sys.argv[1])
+        logStep(str(len(files))+" change files to apply")
+        n.startChanges(files)
+    n.startPhase(phases[0])
+    for path in files:
+        n.read(path)
+    if not single_pass:
+        for phase in phases[1:]:
+            n.startPhase(phase)
+            for path in files:
+                n.read(path)
+    n.finish_remaining_commands()
+    n.closePool()
+    if sorted_path != None:
+        removeFile(sorted_path)
+    for db, writer, zone in outputs:
+        writer.close()
+
+    if BULK_LOAD:
+        logPhase("Building keys and swapping tables...")
+        metrics.setPhase("Finalizing")
+        for db, writer, zone in outputs:
+            db.finalizeBulkLoad()
+
+    for db, writer, zone in outputs:
+        writer.checkpoint.phase = "Done"
+        if db != None:
+            db.execute([writer.checkpoint.command()])
+    metrics.setPhase("Done")
+    reporter.stop()
 
     # Print report to output
     print(green+"Import successful!"+white)
     print("Time elapsed: "+str(time.time()-starting_time))
 
-    print('nodes_discarded: '+str(nodes_discarded))
-    print('ways_discarded: '+str(ways_discarded))
-    print('relations_discarded: '+str(relations_discarded))
+    print('nodes_discarded: '+str(metrics.total('nodes_discarded')))
+    print('ways_discarded: '+str(metrics.total('ways_discarded')))
+    print('relations_discarded: '+str(metrics.total('relations_discarded')))
 
     # Print output tp file
     file = open("logs/"+DB_NAME+"-log.txt","a")
     file.write("\n\n------------------------------\nImport successful!")
     file.write("Time elapsed: "+str(time.time()-starting_time))
 
-    file.write('nodes_discarded: '+str(nodes_discarded))
-    file.write('ways_discarded: '+str(ways_discarded))
-    file.write('relations_discarded: '+str(relations_discarded))
+    file.write('nodes_discarded: '+str(metrics.total('nodes_discarded')))
+    file.write('ways_discarded: '+str(metrics.total('ways_discarded')))
+    file.write('relations_discarded: '+str(metrics.total('relations_discarded')))
 
     file.close()
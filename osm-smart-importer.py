@@ -8,11 +8,17 @@ Simply modify the DB variables, and run using:
 """
 import osmium as o
 import sys
-from datetime import date
+import io
+import struct
+from datetime import date, datetime, timezone
 import time
 import psycopg2
 import pprint
 import json
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Thread
+from queue import Queue
 
 DB_NAME='osmmonaco2'
 DB_USER='Julien'
@@ -24,12 +30,29 @@ NODE_TYPE="Nodes"
 WAY_TYPE="Ways"
 RELATION_TYPE="Relations"
 
+# Batches waiting to be loaded by a PipelineWriter
+PIPELINE_DEPTH=2
+
+# Tables in the order they have to be loaded (parents before children)
+TABLES=['nodes','ways','ways_nodes','relations','relations_members']
+
+# Column types used to encode rows for COPY ... (FORMAT binary):
+# q=bigint, i=int, b=boolean, t=timestamp, s=text/varchar/char, j=jsonb
+COPY_TYPES = {
+    'nodes': 'qbbqqqtsiij',
+    'ways': 'qbbqqqtsj',
+    'ways_nodes': 'qqqqqii',
+    'relations': 'qbbqqqtsj',
+    'relations_members': 'qqqssq',
+}
+
 class DB(object):
     """encaspulate a database connection."""
 
     def __init__(self):
+        self.dsn = "dbname='"+DB_NAME+"' user='"+DB_USER+"' password='"+DB_PWD+"' host='"+DB_HOST+"' port='"+DB_PORT+"'"
         try:
-            self.connection = psycopg2.connect("dbname='"+DB_NAME+"' user='"+DB_USER+"' password='"+DB_PWD+"' host='"+DB_HOST+"' port='"+DB_PORT+"'")
+            self.connection = psycopg2.connect(self.dsn)
         except:
             print('\033[91m'+"Unable to connect to the database."+'\033[0m')
             sys.exit(-1)
@@ -123,31 +146,244 @@ class DB(object):
             print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
             sys.exit(-1)
 
-    def executeAndReturn(self,command):
-        try:
-            cur = self.connection.cursor()
-            # create table one by one
-            cur.execute(command)
+# ============= Row writers ==============
 
-            result = cur.fetchone()
-            # close communication with the PostgreSQL database server
-            cur.close()
+class InsertWriter(object):
+    """write rows as one INSERT statement per row."""
 
-            # commit the changes
-            self.connection.commit()
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+        self.pending = 0
+
+    def add(self, table, row):
+        self.commands.append("INSERT INTO "+table+" VALUES ("+",".join(sqlValue(v) for v in row)+");")
+        self.pending += 1
 
-            return result
+    def flush(self):
+        self.db.execute(self.commands)
+        self.commands = []
+        self.pending = 0
+
+class CopyWriter(object):
+    """buffer rows per table and stream them with COPY ... FROM STDIN."""
+
+    def __init__(self, db, binary=False):
+        self.db = db
+        self.binary = binary
+        self.pending = 0
+        self.buffers = {}
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if binary else io.StringIO()
+
+    def add(self, table, row):
+        if self.binary:
+            self.buffers[table].write(copyBinaryRow(COPY_TYPES[table], row))
+        else:
+            self.buffers[table].write('\t'.join(copyTextValue(v) for v in row)+'\n')
+        self.pending += 1
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        self.load(self.db.connection, self.batch())
+
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if self.binary else io.StringIO()
+        self.pending = 0
+
+    # Encoded rows of each table
+    def batch(self):
+        return dict((table, self.buffers[table].getvalue()) for table in TABLES)
+
+    # Load a batch in one transaction
+    def load(self, connection, data):
+        try:
+            cur = connection.cursor()
+            # Parents are loaded first so that foreign keys are satisfied
+            for table in TABLES:
+                if len(data[table]) == 0:
+                    continue
+                if self.binary:
+                    cur.copy_expert("COPY "+table+" FROM STDIN WITH (FORMAT binary)", io.BytesIO(COPY_BINARY_HEADER + data[table] + COPY_BINARY_TRAILER))
+                else:
+                    cur.copy_expert("COPY "+table+" FROM STDIN", io.StringIO(data[table]))
+            cur.close()
         except (Exception, psycopg2.DatabaseError) as error:
             print('\033[91m'+"\nSQL ERROR:\n"+str(error)+'\033[0m')
             sys.exit(-1)
+        else:
+            connection.commit()
+
+class PipelineWriter(CopyWriter):
+    """CopyWriter loading its batches in a thread, on a connection of its
+    own, while the next batch is being parsed.
 
+    flush() only waits when PIPELINE_DEPTH batches are already waiting
+    to be loaded."""
+
+    def __init__(self, db, binary=False):
+        super(PipelineWriter, self).__init__(db, binary)
+        try:
+            self.connection = psycopg2.connect(db.dsn)
+        except:
+            print('\033[91m'+"Unable to open a second connection to the database."+'\033[0m')
+            sys.exit(-1)
+        self.batches = Queue(maxsize=PIPELINE_DEPTH)
+        self.failed = False
+        self.loader = Thread(target=self.run)
+        # The import can stop while the loader waits for batches
+        self.loader.daemon = True
+        self.loader.start()
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        self.checkFailure()
+        self.batches.put(self.batch())
+
+        for table in TABLES:
+            self.buffers[table] = io.BytesIO() if self.binary else io.StringIO()
+        self.pending = 0
+
+    def run(self):
+        while True:
+            data = self.batches.get()
+            try:
+                if data == None:
+                    break
+                # After a failure, batches are only taken out of the queue
+                # so that the import does not wait for this thread
+                if not self.failed:
+                    self.load(self.connection, data)
+            except BaseException:
+                self.failed = True
+            finally:
+                self.batches.task_done()
+
+    def checkFailure(self):
+        if self.failed:
+            print('\033[91m'+"\nERROR: the loader stopped."+'\033[0m')
+            sys.exit(-1)
+
+    # Wait for every batch to be loaded and release the connection
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.loader.join()
+        self.connection.close()
+        self.checkFailure()
+
+# Escape characters having a special meaning in COPY text format
+COPY_TEXT_ESCAPES = str.maketrans({'\\':'\\\\', '\t':'\\t', '\n':'\\n', '\r':'\\r'})
+
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+def sqlValue(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (bool, int)):
+        return str(value)
+    return "'"+str(value).replace("'","''")+"'"
+
+def copyTextValue(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+def copyBinaryRow(types, row):
+    data = [struct.pack('>h', len(row))]
+    for type, value in zip(types, row):
+        if value is None:
+            data.append(struct.pack('>i', -1))
+        elif type == 'q':
+            data.append(struct.pack('>iq', 8, value))
+        elif type == 'i':
+            data.append(struct.pack('>ii', 4, value))
+        elif type == 'b':
+            data.append(struct.pack('>i?', 1, value))
+        elif type == 't':
+            data.append(struct.pack('>iq', 8, timestampMicros(value)))
+        elif type == 'j':
+            # jsonb binary format is a version byte followed by the text
+            encoded = str(value).encode('utf-8')
+            data.append(struct.pack('>ib', len(encoded)+1, 1))
+            data.append(encoded)
+        else:
+            encoded = str(value).encode('utf-8')
+            data.append(struct.pack('>i', len(encoded)))
+            data.append(encoded)
+    return b''.join(data)
+
+# Microseconds since 2000-01-01, the PostgreSQL timestamp epoch
+def timestampMicros(ts):
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    delta = ts - PG_EPOCH
+    return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+
+# ============= Node versions index ==============
+
+class NodeVersionIndex(object):
+    """versions of the kept nodes in compact arrays, sorted by id then timestamp."""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.timestamps = array('q')
+        self.versions = array('q')
+        self.xs = array('i')
+        self.ys = array('i')
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, version, timestamp, x, y):
+        timestamp = int(timestamp.timestamp())
+        # History files are sorted, so appending usually keeps the order
+        if len(self.ids) > 0 and (id < self.ids[-1] or (id == self.ids[-1] and timestamp < self.timestamps[-1])):
+            self.sorted = False
+        self.ids.append(id)
+        self.timestamps.append(timestamp)
+        self.versions.append(version)
+        self.xs.append(x)
+        self.ys.append(y)
+
+    def sort(self):
+        order = sorted(range(len(self.ids)), key=lambda i: (self.ids[i], self.timestamps[i]))
+        self.ids = array('q', [self.ids[i] for i in order])
+        self.timestamps = array('q', [self.timestamps[i] for i in order])
+        self.versions = array('q', [self.versions[i] for i in order])
+        self.xs = array('i', [self.xs[i] for i in order])
+        self.ys = array('i', [self.ys[i] for i in order])
+        self.sorted = True
+
+    # Return (version, x, y) of the latest node version created at or before
+    # timestamp, or of the first version if all were created after it
+    def lookup(self, id, timestamp):
+        if not self.sorted:
+            self.sort()
+        lo = bisect_left(self.ids, id)
+        hi = bisect_right(self.ids, id, lo)
+        if lo == hi:
+            return None
+        i = bisect_right(self.timestamps, int(timestamp.timestamp()), lo, hi) - 1
+        if i < lo:
+            i = lo
+        return (self.versions[i], self.xs[i], self.ys[i])
 
 class Importer(object):
 
-    def __init__(self,datatype, db):
+    def __init__(self,datatype, db, writer, index):
         self.db = db
+        self.writer = writer
+        self.index = index
         self.datatype=datatype
-        self.insertion_commands=[]
 
     # Deal with one entity (node, way or relation)
     def add(self, o):
@@ -156,109 +392,128 @@ class Importer(object):
         o.jsontags = self.jsonifyTags(o.tags)
 
         if self.datatype==NODE_TYPE:
-            self.insertion_commands.append(self.insertNodeSQL(o))
+            rows = self.nodeRows(o)
         elif self.datatype==WAY_TYPE:
-            self.insertion_commands += self.insertWaySQL(o)
+            rows = self.wayRows(o)
         elif self.datatype==RELATION_TYPE:
-            self.insertion_commands += self.insertRelationSQL(o)
+            rows = self.relationRows(o)
         else:
             print('\033[91m'+"\nERROR: type"+str( self.datatype)+" not found, or not handled."+'\033[0m')
             sys.exit(-1)
 
+        for table, row in rows:
+            self.writer.add(table, row)
+
         # Execute commands every 100000
-        if (len(self.insertion_commands)>100000):
+        if (self.writer.pending>100000):
             self.executeCommands()
 
     def executeCommands(self):
-        self.db.execute( self.insertion_commands )
-        self.insertion_commands = []
-
-    def executeSearchCommand(self,command):
-        return self.db.executeAndReturn(command)
+        self.writer.flush()
 
     def jsonifyTags(self,tags):
         jsontags={}
         for tag in tags:
-            jsontags[tag.k.replace("'","")] = tag.v.replace("'","")
+            jsontags[tag.k] = tag.v
 
         return json.dumps(jsontags)
 
-    # Return a SQL command to insert a node
-    def insertNodeSQL(self,o):
+    # Return the rows to insert a node
+    def nodeRows(self,o):
         if self.datatype!=NODE_TYPE:
             return
 
-        query =  """INSERT INTO nodes VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}',
-        {8},{9},'{10}');"""
-
-        return query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""),o.location.x, o.location.y, o.jsontags)
+        self.index.add(o.id,o.version,o.timestamp,o.location.x,o.location.y)
+        return [('nodes', (o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user,o.location.x, o.location.y, o.jsontags))]
 
-    # Return am array of SQL commands to insert a way
-    def insertWaySQL(self,o):
+    # Return the rows to insert a way and its nodes
+    def wayRows(self,o):
         if self.datatype!=WAY_TYPE:
             return
-        query = """INSERT INTO ways VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}','{8}');"""
 
-        queries = [query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""), o.jsontags)]
+        rows = [('ways', (o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user, o.jsontags))]
 
-        node_way_query = """ INSERT INTO ways_nodes VALUES ({0}, {1}, {2}, {3},{4},{5},{6}) """
         sequence_id=0
 
         for mynode in o.nodes:
-            # filter out way if no o.nodes dans la zoe
-
-            node_query = """SELECT * from nodes where id = {0} and created_at<='{1}' order by created_at desc limit 1;"""
-            current_node = self.executeSearchCommand(node_query.format(mynode.ref,o.timestamp))
+            current_node = self.index.lookup(mynode.ref,o.timestamp)
+            # Skip nodes missing from the file
             if current_node == None:
-                node_query = """SELECT * from nodes where id = {0} order by created_at limit 1;"""
-                current_node = self.executeSearchCommand(node_query.format(mynode.ref,o.timestamp))
+                continue
 
-            queries.append( node_way_query.format(o.id,o.version,mynode.ref,current_node[len(current_node)-8],sequence_id,current_node[len(current_node)-3],current_node[len(current_node)-2]) )
+            rows.append( ('ways_nodes', (o.id,o.version,mynode.ref,current_node[0],sequence_id,current_node[1],current_node[2])) )
             sequence_id += 1
 
-        return queries
+        return rows
 
-    # Return am array of SQL commands to insert a relation
-    def insertRelationSQL(self,o):
+    # Return the rows to insert a relation and its members
+    def relationRows(self,o):
         if self.datatype!=RELATION_TYPE:
             return
-        query = """INSERT INTO relations VALUES ({0}, {1}, {2} , {3}, {4}, {5}, '{6}','{7}','{8}');"""
 
-        queries = [query.format(o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user.replace("'",""), o.jsontags)]
+        rows = [('relations', (o.id,o.deleted,o.visible,o.version,o.changeset,o.uid,o.timestamp,o.user, o.jsontags))]
 
-        node_way_query = """ INSERT INTO relations_members VALUES ({0}, {1}, {2}, '{3}', '{4}', {5}) """
         sequence_id=0
         for member in o.members:
-            queries.append( node_way_query.format(o.id,o.version,member.ref,member.type.replace("'",""),member.role.replace("'",""),sequence_id) )
+            rows.append( ('relations_members', (o.id,o.version,member.ref,member.type,member.role,sequence_id)) )
             sequence_id += 1
 
-        return queries
+        return rows
 
 class FileHandler(o.SimpleHandler):
-    def __init__(self, db):
+    def __init__(self, db, writer, single_pass=False):
         super(FileHandler, self).__init__()
-        self.nodes = Importer(NODE_TYPE,db)
-        self.ways = Importer(WAY_TYPE,db)
-        self.rels = Importer(RELATION_TYPE,db)
+        # Versions of the nodes, used to resolve the nodes of ways
+        self.index = NodeVersionIndex()
+        self.nodes = Importer(NODE_TYPE,db,writer,self.index)
+        self.ways = Importer(WAY_TYPE,db,writer,self.index)
+        self.rels = Importer(RELATION_TYPE,db,writer,self.index)
         self.node_only=True
+        # In single pass mode, nodes are written as soon as the first way
+        # or relation is found (history files are sorted by type)
+        self.single_pass=single_pass
 
     def node(self, n):
         if(self.node_only):
             self.nodes.add(n)
+        elif self.single_pass:
+            print('\033[91m'+"\nERROR: node "+str(n.id)+" found after ways or relations, the file is not sorted."+'\033[0m')
+            sys.exit(-1)
 
     def way(self, w):
+        if self.single_pass and self.node_only:
+            self.end_nodes()
         if(not self.node_only):
-	        self.ways.add(w)
+            self.ways.add(w)
 
     def relation(self, r):
+        if self.single_pass and self.node_only:
+            self.end_nodes()
         if(not self.node_only):
-	        self.rels.add(r)
+            self.rels.add(r)
+
+    # Write the nodes left before ways are resolved
+    def end_nodes(self):
+        self.node_only = False
+        self.finish_remaining_commands()
+        print("Parsing and importing the rest... ",end='')
 
     def finish_remaining_commands(self):
         self.nodes.executeCommands()
         self.ways.executeCommands()
         self.rels.executeCommands()
 
+# Extract "--name" or "--name=value" from the command line arguments
+def getOption(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg == '--'+name:
+            sys.argv.remove(arg)
+            return True
+        if arg.startswith('--'+name+'='):
+            sys.argv.remove(arg)
+            return arg.split('=',1)[1]
+    return default
+
 if __name__ == '__main__':
     white = '\033[0m'
     blue = '\033[94m'
@@ -271,26 +526,38 @@ if __name__ == '__main__':
 
     starting_time = time.time()
 
+    # Options: --copy (COPY text format) or --copy=binary,
+    # --single-pass to read the file once instead of twice,
+    # --pipeline to load the rows with COPY in a thread while parsing goes on
+    copy_mode = getOption('copy')
+    single_pass = getOption('single-pass', False)
+    pipeline = getOption('pipeline', False)
+
     if len(sys.argv) != 2:
-        print("Usage: python osm-importer.py <osmfile>")
+        print("Usage: python osm-importer.py <osmfile> [--copy[=binary]] [--single-pass] [--pipeline]")
         sys.exit(-1)
 
-    print(orange+"\nWarning: All single quote ' are deleted in tags and users'name"+white)
-
     # Create connection with db and file importer
     print("\nConnecting to db... ",end='')
     db = DB()
+    if pipeline:
+        writer = PipelineWriter(db, binary=(copy_mode == 'binary'))
+    elif copy_mode:
+        writer = CopyWriter(db, binary=(copy_mode == 'binary'))
+    else:
+        writer = InsertWriter(db)
     print("OK")
 
     # Parse file and importing
     print("Parsing and importing nodes... ",end='')
-    n = FileHandler(db)
-    n.apply_file(sys.argv[1])
-    n.node_only = False
-    n.finish_remaining_commands()
-    print("Parsing and importing the rest... ",end='')
+    n = FileHandler(db, writer, single_pass)
     n.apply_file(sys.argv[1])
+    if not single_pass:
+        n.end_nodes()
+        n.apply_file(sys.argv[1])
     n.finish_remaining_commands()
+    if pipeline:
+        writer.close()
 
     print(green+"Import successful!"+white)
     print(time.time()-starting_time)